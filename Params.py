@@ -5,7 +5,69 @@ Created on Thu Nov 19 14:36:59 2015
 @author: rrowekamp
 """
 
-from numpy import fromfile,prod,sqrt,ndarray
+from numpy import fromfile,prod,sqrt,ndarray,empty,result_type,ndim,dot
+from numpy import ascontiguousarray,empty_like,multiply,memmap
+from numpy import dtype as dtype_
+from io import IOBase
+from struct import pack,unpack
+import json
+
+# Parameter files written by Params.save start with MAGIC, the format version
+# and the length of a JSON header describing the parameters and model. The
+# values follow the header, starting at a multiple of ALIGN bytes so that they
+# can be memory mapped. Files without MAGIC hold only the raw values.
+MAGIC = b'\x93PARAMS'
+VERSION = 1
+ALIGN = 64
+
+# Reads header of parameter file f, leaving f at the start of the values.
+# Returns None and leaves f unchanged if f holds raw values.
+def readHeader(f):
+
+    pos = f.tell()
+    if f.read(len(MAGIC)) != MAGIC:
+        f.seek(pos)
+        return None
+
+    version,size = unpack('<HI',f.read(6))
+    if version > VERSION:
+        raise ValueError('Parameter file version %u is newer than supported version %u' % (version,VERSION))
+
+    return json.loads(f.read(size).decode('utf-8'))
+
+"""
+Loads parameters from file name written by Params.save, memory mapped unless
+mmap_mode is None. Files of raw values need shapes and are read as dtype
+(float if None).
+Returns Params object and dictionary with the header of the file (empty for
+raw files).
+"""
+def loadParams(name,shapes=None,dtype=None,mmap_mode='r'):
+
+    with open(name,'rb') as f:
+        header = readHeader(f)
+        offset = f.tell()
+
+    if header is None:
+        # shapes is needed to structure loaded values
+        assert shapes is not None
+        header = {}
+        fileType = float if dtype is None else dtype
+    else:
+        if shapes is None:
+            shapes = header['shapes']
+        fileType = header['dtype']
+
+    count = sum([int(prod(s)) for s in shapes])
+    if mmap_mode is None:
+        buf = fromfile(name,dtype=fileType,count=count,offset=offset)
+    else:
+        buf = memmap(name,dtype=fileType,mode=mmap_mode,offset=offset,shape=(count,))
+    if dtype is not None and buf.dtype != dtype_(dtype):
+        buf = buf.astype(dtype)
+
+    return Params(buf,shapes),header
+
 
 class Params(object):
     """
@@ -13,6 +75,9 @@ class Params(object):
     paramters of a model. The parameters can be mathematically manipulated as
     a whole, which is useful for gradient descent. The class also has support
     for copying itself and saving or loading parameters to or from files.
+    The parameters are stored one after another in a single contiguous vector
+    (buffer) and each parameter is a view of its part of it, so operations
+    between Params and with scalars act on the whole vector at once.
     Constructor inputs:
         params: Can be a file object, a file name, a Params object, a numpy
             array, or a list or tuple of numpy arrays.
@@ -31,60 +96,139 @@ class Params(object):
                  ):
 
         # If params is an open file, load parameters from it.
-        if isinstance(params,file):
-            # shapes is needed to structure loaded values
-            assert shapes is not None
-            if dtype is None:
-                dtype = float
-            self.params = [fromfile(params,count=prod(s),dtype=dtype).reshape(s) for s in shapes]
+        if isinstance(params,IOBase):
+            self.load(params,shapes,dtype)
 
         # If params is a string, try opening that file and loading params from it
         elif isinstance(params,str):
-            # shapes is needed to structure loaded values
-            assert shapes is not None
-            if dtype is None:
-                dtype = float
-            with open(params,'r') as f:
-                self.params = [fromfile(f,count=prod(s),dtype=dtype).reshape(s) for s in shapes]
+            with open(params,'rb') as f:
+                self.load(f,shapes,dtype)
 
         # Copy values from Params object, reshaping and changing dtype if necessary
         elif isinstance(params,Params):
             if dtype is None:
-                self.params = [p for p in params.getParams()]
+                buf = params.buffer.copy()
             else:
-                self.params = [p.astype(dtype) for p in params.getParams()]
-            if shapes is not None:
-                for p,s in zip(self.params,shapes):
-                    p.shape = s
+                buf = params.buffer.astype(dtype)
+            if shapes is None:
+                shapes = params.shapes
+            self.setBuffer(buf,shapes)
 
         elif isinstance(params,ndarray):
             assert params.ndim == 1
             # If params is an array of arrays
             if isinstance(params[0],ndarray):
-                if dtype is None:
-                    self.params = [p.copy() for p in params]
-                else:
-                    self.params = [p.astype(dtype) for p in params]
+                self.setParams(params,dtype)
 
-            # if params is a vector of values
+            # if params is a vector of values. The parameters are views of it
+            # unless dtype is given.
             else:
                 assert shapes is not None
-                size = [prod(s) for s in shapes]
-                size.insert(0,0)
-                assert params.size == sum(size)
-                ind = [sum(size[:j+1]) for j in range(len(size))]
+                assert params.size == sum([int(prod(s)) for s in shapes])
                 if dtype is None:
-                    self.params = [params[ind[j]:ind[j+1]].reshape(shapes[j]) for j in range(len(size)-1)]
+                    self.setBuffer(ascontiguousarray(params),shapes)
                 else:
-                    self.params = [params[ind[j]:ind[j+1]].reshape(shapes[j]).astype(dtype) for j in range(len(size)-1)]
+                    self.setBuffer(params.astype(dtype),shapes)
 
         # If params is a list/tuple of arrays
         else:
             assert isinstance(params,tuple) or isinstance(params,list)
-            if dtype is None:
-                self.params = [p.copy() for p in params]
-            else:
-                self.params = [p.astype(dtype) for p in params]
+            self.setParams(params,dtype)
+
+    # Copies arrays in params into a new buffer
+    def setParams(self,params,dtype=None):
+
+        if dtype is None:
+            dtype = result_type(*params)
+        self.shapes = [p.shape for p in params]
+        self.offsets = [0]
+        for p in params:
+            self.offsets.append(self.offsets[-1]+p.size)
+        self.buffer = empty(self.offsets[-1],dtype=dtype)
+        self.params = self.views(self.buffer)
+        self.scratch = None
+        for AA,BB in zip(self.params,params):
+            AA[...] = BB
+
+    # Uses vector buf as buffer with parameters of the given shapes as views
+    def setBuffer(self,buf,shapes):
+
+        self.shapes = [tuple(s) for s in shapes]
+        self.offsets = [0]
+        for s in self.shapes:
+            self.offsets.append(self.offsets[-1]+int(prod(s)))
+        self.buffer = buf
+        self.params = self.views(buf)
+        self.scratch = None
+
+    # Returns views of vector buf with the shapes of the parameters
+    def views(self,buf):
+
+        return [buf[j:k].reshape(s) for j,k,s in
+                zip(self.offsets[:-1],self.offsets[1:],self.shapes)]
+
+    # Returns Params with the same shapes using vector buf as buffer
+    def new(self,buf):
+
+        P = Params.__new__(Params)
+        P.shapes = self.shapes
+        P.offsets = self.offsets
+        P.buffer = buf
+        P.params = self.views(buf)
+        P.scratch = None
+
+        return P
+
+    # Reads parameters from open file f written by save. Files of raw values
+    # need shapes and are read as dtype (float if None).
+    def load(self,f,shapes=None,dtype=None):
+
+        header = readHeader(f)
+        if header is None:
+            # shapes is needed to structure loaded values
+            assert shapes is not None
+            fileType = float if dtype is None else dtype
+        else:
+            if shapes is None:
+                shapes = header['shapes']
+            fileType = header['dtype']
+
+        buf = fromfile(f,count=sum([int(prod(s)) for s in shapes]),dtype=fileType)
+        if dtype is not None and buf.dtype != dtype_(dtype):
+            buf = buf.astype(dtype)
+        self.setBuffer(buf,shapes)
+
+    # Saves parameters to f with a header holding their shapes and dtype and
+    # the entries of meta, which must be serializable as JSON (numpy arrays
+    # are stored as lists)
+    def save(self,f,**meta):
+
+        header = dict(meta,shapes=self.shapes,dtype=self.buffer.dtype.str)
+        header = json.dumps(header,default=lambda x: x.tolist()).encode('utf-8')
+        header += b' '*(-(len(MAGIC)+6+len(header)) % ALIGN)
+
+        if isinstance(f,IOBase):
+            F = f
+        else:
+            F = open(f,'wb')
+        try:
+            F.write(MAGIC)
+            F.write(pack('<HI',VERSION,len(header)))
+            F.write(header)
+            F.write(ascontiguousarray(self.buffer).data)
+        finally:
+            if F is not f:
+                F.close()
+
+    # Pickles only the buffer and shapes, so that the parameters are views of
+    # the buffer again when unpickled
+    def __getstate__(self):
+
+        return {'buffer':self.buffer,'shapes':self.shapes}
+
+    def __setstate__(self,state):
+
+        self.setBuffer(state['buffer'],state['shapes'])
 
     # Returns a list with copies of the parameters
     def getParams(self):
@@ -94,303 +238,218 @@ class Params(object):
     # Returns a Params object with copies of the parameters
     def copy(self):
 
-        return Params(self.getParams())
+        return self.new(self.buffer.copy())
 
-    # Left addition
-    def __add__(self,A):
+    # Returns other operand as a vector matching the buffer, or None if it is
+    # an array applied to each parameter separately
+    def flat(self,A):
 
         if isinstance(A,Params):
+            return A.buffer
+        elif ndim(A) == 0:
+            return A
+        else:
+            return None
 
-            p1 = self.params
-            p2 = A.getParams()
+    # Left addition
+    def __add__(self,A):
 
-            return Params([AA+BB for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([AA+A for AA in self.params])
+        return self.new(self.buffer+B)
 
     # Right addition
     def __radd__(self,A):
 
-        if isinstance(A,Params):
-
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([BB+AA for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([A+AA for AA in self.params])
+        return self.new(B+self.buffer)
 
     # Left subtraction
     def __sub__(self,A):
 
-        if isinstance(A,Params):
-
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([AA-BB for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([AA-A for AA in self.params])
+        return self.new(self.buffer-B)
 
     # Right subtraction
     def __rsub__(self,A):
 
-        if isinstance(A,Params):
-
-
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([BB-AA for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([A-AA for AA in self.params])
+        return self.new(B-self.buffer)
 
     # Left multiplication
     def __mul__(self,A):
 
-        if isinstance(A,Params):
-
-            p1 = self.params
-            p2 = A.getParams()
-            return Params([AA*BB for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([AA*A for AA in self.params])
+        return self.new(self.buffer*B)
 
     # Right multiplication
     def __rmul__(self,A):
 
-        if isinstance(A,Params):
-
-            p1 = self.params
-            p2 = A.getParams()
-            return Params([BB*AA for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([A*AA for AA in self.params])
+        return self.new(B*self.buffer)
 
     # Left floor division
     def __floordiv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([AA//BB for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([AA//A for AA in self.params])
+        return self.new(self.buffer//B)
 
     # Left division
     def __div__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([AA/BB for AA,BB in zip(p1,p2)])
-        else:
-            return Params([AA/A for AA in self.params])
+        return self.__truediv__(A)
 
     # Left true division
     def __truediv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([AA/BB for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([AA/A for AA in self.params])
+        return self.new(self.buffer/B)
 
     # Right floor division
     def __rfloordiv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([BB//AA for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([A//AA for AA in self.params])
+        return self.new(B//self.buffer)
 
     # Right division
     def __rdiv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([BB/AA for AA,BB in zip(p1,p2)])
-        else:
-            return Params([A/AA for AA in self.params])
+        return self.__rtruediv__(A)
 
     # Right true division
     def __rtruediv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([BB/AA for AA,BB in zip(p1,p2)])
-        else:
+        B = self.flat(A)
+        if B is None:
             return Params([A/AA for AA in self.params])
+        return self.new(B/self.buffer)
 
     # Left power
     def __pow__(self,A):
 
-        if isinstance(A,Params):
-
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([AA**BB for AA,BB in zip(p1,p2)])
-        else:
-
+        B = self.flat(A)
+        if B is None:
             return Params([AA**A for AA in self.params])
+        return self.new(self.buffer**B)
 
     # Right power
     def __rpow__(self,A):
 
-        if isinstance(A,Params):
-
-            p1 = self.params
-            p2 = A.getParams()
-
-            return Params([BB**AA for AA,BB in zip(p1,p2)])
-        else:
-
+        B = self.flat(A)
+        if B is None:
             return Params([A**AA for AA in self.params])
+        return self.new(B**self.buffer)
 
     # In-place addition
     def __iadd__(self,A):
 
-        if isinstance(A,Params):
-
-            p2 = A.getParams()
-
-            for AA,BB in zip(self.params,p2):
-                AA += BB
-
-            return self
-        else:
-
+        B = self.flat(A)
+        if B is None:
             for AA in self.params:
                 AA += A
+        else:
+            self.buffer += B
 
-            return self
+        return self
 
     # In-place subtraction
     def __isub__(self,A):
 
-        if isinstance(A,Params):
-
-            p2 = A.getParams()
-
-            for AA,BB in zip(self.params,p2):
-                AA -= BB
-
-            return self
-        else:
-
+        B = self.flat(A)
+        if B is None:
             for AA in self.params:
                 AA -= A
+        else:
+            self.buffer -= B
 
-            return self
+        return self
 
     # In-place multiplication
     def __imul__(self,A):
 
-        if isinstance(A,Params):
-
-            p2 = A.getParams()
-
-            for AA,BB in zip(self.params,p2):
-                AA *= BB
-
-            return self
-        else:
-
+        B = self.flat(A)
+        if B is None:
             for AA in self.params:
                 AA *= A
+        else:
+            self.buffer *= B
 
-            return self
+        return self
 
     # In-place floor division
     def __ifloordiv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            for AA,BB in zip(p1,p2):
-                AA //= BB
-
-            return self
-        else:
-
+        B = self.flat(A)
+        if B is None:
             for AA in self.params:
                 AA //= A
+        else:
+            self.buffer //= B
 
-            return self
+        return self
 
     # In-place division
     def __idiv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            for AA,BB in zip(p1,p2):
-                AA /= BB
-
-            return self
-        else:
-
-            for AA in self.params:
-                AA /= A
-
-            return self
+        return self.__itruediv__(A)
 
     # In-place true division
     def __itruediv__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
-
-            for AA,BB in zip(p1,p2):
-                AA /= BB
-
-            return self
-        else:
-
+        B = self.flat(A)
+        if B is None:
             for AA in self.params:
                 AA /= A
+        else:
+            self.buffer /= B
 
-            return self
+        return self
 
     # In-place power
     def __ipow__(self,A):
 
-        if isinstance(A,Params):
-            p1 = self.params
-            p2 = A.getParams()
+        B = self.flat(A)
+        if B is None:
+            for AA in self.params:
+                AA **= A
+        else:
+            self.buffer **= B
 
-            for AA,BB in zip(p1,p2):
-                AA **= BB
+        return self
 
-            return self
-        else:
+    # In-place update self += a*X with scalar a and Params X. a*X is formed
+    # in a scratch vector kept between calls, so repeated updates do not
+    # allocate memory.
+    def axpy(self,a,X):
 
-            for AA in self.params:
-                AA **= A
+        if self.scratch is None:
+            self.scratch = empty_like(self.buffer)
+        multiply(X.buffer,a,out=self.scratch)
+        self.buffer += self.scratch
 
-            return self
+        return self
 
     # Negation
     def __neg__(self):
 
-        params = [-p for p in self.params]
-
-        return Params(params)
+        return self.new(-self.buffer)
 
     # Slicing
     def __getitem__(self,sliced):
@@ -400,7 +459,7 @@ class Params(object):
     # Absolute value
     def __abs__(self):
 
-        return Params([abs(A) for A in self.params])
+        return self.new(abs(self.buffer))
 
     # Length
     def __len__(self):
@@ -410,35 +469,28 @@ class Params(object):
     # Sum of all parameters
     def sum(self):
 
-        return sum([A.sum() for A in self.params])
+        return self.buffer.sum()
 
     # Saves parameters to f as dtype if given
     def tofile(self,f,dtype=None):
 
-        if isinstance(f,file):
-
-            for p in self.params:
-                if dtype is None:
-                    p.tofile(f)
-                else:
-                    p.astype(dtype).tofile(f)
-
+        if dtype is None:
+            buf = self.buffer
         else:
+            buf = self.buffer.astype(dtype)
 
-            with open(f,'w') as F:
-                for p in self.params:
-                    if dtype is None:
-                        p.tofile(F)
-                    else:
-                        p.astype(dtype).tofile(F)
+        if isinstance(f,IOBase):
+            buf.tofile(f)
+        else:
+            with open(f,'wb') as F:
+                buf.tofile(F)
 
     # Return L2 norm of parameter vector
     def norm(self):
 
-        return sqrt(sum([(p**2).sum() for p in self.params]))
+        return sqrt(dot(self.buffer,self.buffer))
 
     # Return copy with given dtype
     def astype(self,dtype):
 
-        return Params([p.astype(dtype) for p in self.params])
-
+        return self.new(self.buffer.astype(dtype))
@@ -0,0 +1,146 @@
+"""
+FFT engine for the first layer. Instead of taking the dot product of the
+filters with the patch at every grid location, the filters are correlated
+with the full stimulus window using FFTs. The quadratic term is evaluated
+from the eigendecomposition of J, J = sum_k w[k]*U[k]*U[k].T, so that it
+is sum_k w[k]*(U[k]*S)**2 and each U[k]*S is a correlation.
+"""
+from numpy import conj, log2, prod, abs as aabs
+from numpy import tensordot as tdot
+from numpy.fft import rfftn, irfftn
+from numpy.linalg import eigh
+
+from math_utils import logistic, softPlus, unpackSym
+from Params import Params
+
+
+# Estimate whether the FFT engine is cheaper than direct evaluation
+def fftFaster(fsize, # Shape of first layer filter
+              gsize, # Shape of grid
+              nquad, # Number of quadratic filters (npix for full J, rank for low rank)
+              fftScale=1. # Relative cost of the FFT engine on this machine
+              ):
+
+    npix = prod(fsize)
+    G = prod(gsize)
+    M = prod([f+g-1 for f,g in zip(fsize,gsize)])
+
+    # Costs are in units of the time to gather one patch element, fit to
+    # timings of both engines for patches of 3x3x2 to 16x16x1 on grids of 6x5
+    # to 41x41 with 0 to npix quadratic filters.
+    # Direct: gathering each patch dominates the linear term, while the
+    # quadratic term is a matrix product that runs roughly 40 times faster
+    # per operation. Each grid location adds a fixed overhead.
+    direct = npix*G*(1+nquad/40.)+9*G
+    # FFT: the transform of the window and the linear filter cost about as
+    # much as 12 operations per window element, and each quadratic filter
+    # adds an inverse transform
+    fft = M*(log2(M)*nquad+12)
+
+    return fftScale*fft < direct
+
+# Convert quadratic model parameters to low rank form using eigendecomposition
+# of J. Linear and low rank parameters are returned unchanged.
+def eigParams(P,
+              tol=1e-8 # Eigenvalues smaller than tol times the largest are dropped
+              ):
+
+    if len(P) != 6:
+        return P
+
+    a1,v1,J,a2,v2,d = P
+    npix = v1.size
+
+    if J.ndim == 1:
+        J = unpackSym(J)
+    lam,vec = eigh(J.reshape(npix,npix))
+
+    ind = aabs(lam) > tol*aabs(lam).max()
+    w = lam[ind]
+    U = vec[:,ind].T.reshape(w.shape+v1.shape)
+
+    return Params([a1,v1,U,w,a2,v2,d])
+
+# Correlate filters with stimulus windows
+def corrFFT(FW, # FFT of stimulus windows
+            Ff, # Conjugate FFT of filters with filter number as first dimension
+            wsize, # Shape of windows
+            gsize  # Shape of grid
+            ):
+
+    ndim = len(wsize)
+    c = irfftn(FW.reshape(FW.shape[:1]+(1,)+FW.shape[1:])*Ff,wsize,tuple(range(2,ndim+2)))
+
+    # Keep grid locations where filter does not wrap around the window
+    return c[2*(slice(None),)+tuple([slice(g) for g in gsize])]
+
+# First layer input for every grid location in a batch of stimulus windows
+def driveFFT(W, # Stimulus windows with sample number as first dimension
+             P, # Linear or low rank model parameters (see eigParams)
+             maxSize=2**22 # Maximum number of elements in intermediate arrays
+             ):
+
+    v1 = P[1]
+    ndim = v1.ndim
+    wsize = W.shape[1:]
+    gsize = tuple([F-f+1 for F,f in zip(wsize,v1.shape)])
+    axes = tuple(range(1,ndim+1))
+
+    FW = rfftn(W,axes=axes)
+
+    x1 = corrFFT(FW,conj(rfftn(v1.reshape((1,)+v1.shape),wsize,axes)),wsize,gsize)[:,0]
+
+    # Correlate quadratic filters in groups to bound memory
+    if len(P) == 7:
+        U,w = P[2:4]
+        Ff = conj(rfftn(U,wsize,axes))
+        ng = max(1,maxSize//(W.size))
+        for j in range(0,w.size,ng):
+            c = corrFFT(FW,Ff[j:j+ng],wsize,gsize)
+            x1 += tdot(c**2,w[j:j+ng],((1,),(0,)))
+
+    return x1.reshape(x1.shape[:1]+(-1,)).astype(W.dtype,copy=False)
+
+# Calculates responses of models with softplus output for a batch of windows
+def respSPFFT(W,P):
+    # Inputs:
+    #   W - Stimulus windows with sample number as first dimension
+    #   P - Linear or low rank model parameters (see eigParams)
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    a1,v1 = P[:2]
+    a2,v2,d = P[-3:]
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    # Calculate first layer responses
+    r1 = f1(a1+driveFFT(W,P))
+
+    # Calculate second layer responses
+    r2 = f2(a2+r1.dot(v2.ravel()))
+
+    return d*r2
+
+# Calculates responses of models with logistic output for a batch of windows
+def respLog2FFT(W,P):
+    # Inputs:
+    #   W - Stimulus windows with sample number as first dimension
+    #   P - Linear or low rank model parameters (see eigParams)
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    a1,v1 = P[:2]
+    a2,v2,d = P[-3:]
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    # Calculate first layer responses
+    r1 = f1(a1+driveFFT(W,P))
+
+    # Calculate second layer responses
+    r2 = f2(a2+r1.dot(v2.ravel()))
+
+    return d*r2
@@ -0,0 +1,91 @@
+"""
+Tools for writing output files
+"""
+from collections import OrderedDict
+from os import replace, fsync, getpid
+
+from utils import BackgroundWorker
+
+# Writes data to file name through a temporary file that replaces it, so an
+# interrupted write leaves the previous file intact
+def writeAtomic(name,data):
+
+    temp = name+'.%u.tmp' % (getpid(),)
+    with open(temp,'wb') as f:
+        f.write(data)
+        f.flush()
+        fsync(f.fileno())
+    replace(temp,name)
+
+# Appends data to file name
+def writeAppend(name,data):
+
+    with open(name,'ab') as f:
+        f.write(data)
+
+class BackgroundWriter(BackgroundWorker):
+    """
+    BackgroundWriter writes files from a background thread so that the caller
+    does not wait for storage (see BackgroundWorker). Writes to each file are
+    done in the order they were requested. A write that replaces a file
+    discards writes to it that have not started yet, so only the latest
+    contents reach disk when writes come faster than storage allows.
+    Constructor inputs:
+        background: If False, files are written immediately by the caller.
+        maxPending: Maximum number of writes waiting in the queue. Further
+            writes wait until the queue has room.
+    """
+    def __init__(self,background=True,maxPending=16):
+
+        self.maxPending = maxPending
+        self.pending = OrderedDict()
+        self.count = 0
+        BackgroundWorker.__init__(self,background)
+
+    # Replace contents of file name with bytes data
+    def write(self,name,data):
+
+        self.put(name,writeAtomic,data,True)
+
+    # Append bytes data to file name
+    def append(self,name,data):
+
+        self.put(name,writeAppend,data,False)
+
+    # Queue write of data to file name
+    def put(self,name,func,data,replaces):
+
+        if not self.background:
+            func(name,data)
+            return
+
+        with self.cond:
+            self.check()
+            assert not self.closed
+            if replaces and name in self.pending:
+                self.count -= len(self.pending.pop(name))
+            while self.count >= self.maxPending:
+                self.cond.wait()
+                self.check()
+            self.pending.setdefault(name,[]).append((func,data))
+            self.count += 1
+            self.cond.notify_all()
+
+    def waiting(self):
+
+        return bool(self.pending)
+
+    # Writes queued for one file at a time
+    def take(self):
+
+        return self.pending.popitem(last=False)
+
+    def work(self,task):
+
+        name,ops = task
+        for func,data in ops:
+            func(name,data)
+
+    def finish(self,task):
+
+        self.count -= len(task[1])
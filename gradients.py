@@ -1,16 +1,60 @@
 from math_utils import *
 from numpy import tensordot as tdot
+from numpy import dot, matmul, multiply, empty
 from Params import Params
+from utils import flatStim
 
 
 """
-Gradients for the different models
+Gradients for the different models. With fused=True, each function also
+returns the response of the model and the summed cost for the samples, which
+are computed from the same intermediate values as the gradient. If out is a
+Params of the same shapes, the gradient is written into it and out is
+returned instead of a new Params. The per-sample functions compute the large
+terms directly into the arrays of out, so they allocate no gradient arrays.
+A quadratic filter J1 with one dimension is the upper triangle of J (see
+packSym). Its gradient is the upper triangle of the full gradient, so updates
+match those of the full, symmetric J.
 """
 
+# Returns list of gradients as Params, copying them into out if given.
+# Gradients that are already arrays of out are not copied.
+def gradParams(grads,out=None):
+
+    if out is None:
+        return Params(grads)
+
+    for AA,BB in zip(out,grads):
+        if AA is not BB:
+            AA[...] = BB
+
+    return out
+
+# Returns gradients as Params (see gradParams). If fused, also returns the
+# model responses R and their summed cost.
+def gradResult(grads,out,Y,R,fused):
+
+    G = gradParams(grads,out)
+    if fused:
+        return G,R,llike(Y,R)*R.size
+
+    return G
+
+# Array to compute gradient k into: the array of out if given, otherwise a
+# new array
+def gradArray(out,k,shape,dtype):
+
+    if out is None:
+        return empty(shape,dtype)
+
+    return out[k]
+
 # Calculate gradient for softplus model
 def gradSP(Y, # Observed response
            S, # Stimulus
-           P  # Parameters
+           P, # Parameters
+           fused=False, # Also return response and cost
+           out=None # Params to write gradient into
            ):
 
     # Extract parameters
@@ -24,6 +68,11 @@ def gradSP(Y, # Observed response
 
     ndim = v1.ndim
 
+    # Quadratic filter may be stored as its upper triangle
+    packed = J1.ndim == 1
+    if packed:
+        J1 = unpackSym(J1).reshape(2*v1.shape)
+
     x1 = a1+tdot(v1,S,2*(list(range(ndim)),))+(tdot(J1,S,2*(list(range(ndim)),))*S).sum(tuple(range(ndim)))
     r1 = f1(x1)
     dr1 = df1(x1)
@@ -34,19 +83,37 @@ def gradSP(Y, # Observed response
     dy = d*dfe(Y,d*r2)
     dd = dy*r2/d
 
-    da2 = dy*dr2
-    dv2 = dy*dr2*r1
+    g = dy*dr2
+    n = v1.size
+    Sf = S.reshape(n,-1)
+    wv = (dr1*v2).ravel()
+
+    da2 = g
+    dv2 = multiply(r1,g,out=gradArray(out,4,v2.shape,v1.dtype))
 
-    da1 = dy*dr2*(dr1*v2).sum()
-    dv1 = dy*dr2*tdot(dr1*S,v2,(list(range(-ndim,0)),list(range(ndim))))
-    dJ1 = dy*dr2*tdot(dr1*S*S.reshape(S.shape[:ndim]+ndim*(1,)+S.shape[ndim:]),v2,(list(range(-ndim,0)),list(range(ndim))))
+    da1 = g*wv.sum()
+    dv1 = gradArray(out,1,v1.shape,v1.dtype)
+    dot(Sf,wv,out=dv1.reshape(n))
+    dv1 *= g
 
-    return Params([da1,dv1,dJ1,da2,dv2,dd])
+    # Weight each grid location's outer product by dr1*v2 as S*W*S.T rather
+    # than forming the outer product at every grid location
+    if packed:
+        dJ1 = packSym(dot(Sf*wv,Sf.T),gradArray(out,2,(n*(n+1)//2,),v1.dtype))
+    else:
+        dJ1 = gradArray(out,2,J1.shape,v1.dtype)
+        dot(Sf*wv,Sf.T,out=dJ1.reshape(n,n))
+    dJ1 *= g
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dJ1,da2,dv2,dd],out,Y,d*r2,fused)
 
 # Calculate gradient for linear softplus model
 def gradLinearSP(Y, # Observed response
                  S, # Stimulus
-                 P  # Parameters
+                 P, # Parameters
+                 fused=False, # Also return response and cost
+                 out=None # Params to write gradient into
                  ):
 
     # Extract parameters
@@ -70,18 +137,27 @@ def gradLinearSP(Y, # Observed response
     dy = d*dfe(Y,d*r2)
     dd = dy*r2/d
 
-    da2 = dy*dr2
-    dv2 = dy*dr2*r1
+    g = dy*dr2
+    n = v1.size
+    wv = (dr1*v2).ravel()
+
+    da2 = g
+    dv2 = multiply(r1,g,out=gradArray(out,3,v2.shape,v1.dtype))
 
-    da1 = dy*dr2*(dr1*v2).sum()
-    dv1 = dy*dr2*tdot(dr1*S,v2,(list(range(-ndim,0)),list(range(ndim))))
+    da1 = g*wv.sum()
+    dv1 = gradArray(out,1,v1.shape,v1.dtype)
+    dot(S.reshape(n,-1),wv,out=dv1.reshape(n))
+    dv1 *= g
 
-    return Params([da1,dv1,da2,dv2,dd])
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,da2,dv2,dd],out,Y,d*r2,fused)
 
 # Calculate gradient for logistic model
 def gradLog2(Y, # Observed response
              S, # Stimulus
-             P  # Parameters
+             P, # Parameters
+             fused=False, # Also return response and cost
+             out=None # Params to write gradient into
              ):
 
     # Extract parameters
@@ -95,6 +171,11 @@ def gradLog2(Y, # Observed response
 
     ndim = v1.ndim
 
+    # Quadratic filter may be stored as its upper triangle
+    packed = J1.ndim == 1
+    if packed:
+        J1 = unpackSym(J1).reshape(2*v1.shape)
+
     x1 = a1+tdot(v1,S,2*(list(range(ndim)),))+(tdot(J1,S,2*(list(range(ndim)),))*S).sum(tuple(range(ndim)))
     r1 = f1(x1)
     dr1 = df1(x1)
@@ -105,19 +186,37 @@ def gradLog2(Y, # Observed response
     dy = d*dfe(Y,d*r2)
     dd = dy*r2/d
 
-    da2 = dy*dr2
-    dv2 = dy*dr2*r1
+    g = dy*dr2
+    n = v1.size
+    Sf = S.reshape(n,-1)
+    wv = (dr1*v2).ravel()
 
-    da1 = dy*dr2*(dr1*v2).sum()
-    dv1 = dy*dr2*tdot(dr1*S,v2,(list(range(-ndim,0)),list(range(ndim))))
-    dJ1 = dy*dr2*tdot(dr1*S*S.reshape(S.shape[:ndim]+ndim*(1,)+S.shape[ndim:]),v2,(list(range(-ndim,0)),list(range(ndim))))
+    da2 = g
+    dv2 = multiply(r1,g,out=gradArray(out,4,v2.shape,v1.dtype))
 
-    return Params([da1,dv1,dJ1,da2,dv2,dd])
+    da1 = g*wv.sum()
+    dv1 = gradArray(out,1,v1.shape,v1.dtype)
+    dot(Sf,wv,out=dv1.reshape(n))
+    dv1 *= g
+
+    # Weight each grid location's outer product by dr1*v2 as S*W*S.T rather
+    # than forming the outer product at every grid location
+    if packed:
+        dJ1 = packSym(dot(Sf*wv,Sf.T),gradArray(out,2,(n*(n+1)//2,),v1.dtype))
+    else:
+        dJ1 = gradArray(out,2,J1.shape,v1.dtype)
+        dot(Sf*wv,Sf.T,out=dJ1.reshape(n,n))
+    dJ1 *= g
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dJ1,da2,dv2,dd],out,Y,d*r2,fused)
 
 # Calculate gradient for linear logistic model
 def gradLinearLog2(Y, # Observed response
                    S, # Stimulus
-                   P  # Parameters
+                   P, # Parameters
+                   fused=False, # Also return response and cost
+                   out=None # Params to write gradient into
                    ):
 
     # Extract parameters
@@ -127,7 +226,7 @@ def gradLinearLog2(Y, # Observed response
     f1,f2 = logistic,logistic
 
     # Derivative of model nonlinearities and cost function
-    df1,df2,dfe = dlog,dSP,dllike
+    df1,df2,dfe = dlog,dlog,dllike
 
     ndim = v1.ndim
 
@@ -141,10 +240,405 @@ def gradLinearLog2(Y, # Observed response
     dy = d*dfe(Y,d*r2)
     dd = dy*r2/d
 
-    da2 = dy*dr2
-    dv2 = dy*dr2*r1
+    g = dy*dr2
+    n = v1.size
+    wv = (dr1*v2).ravel()
+
+    da2 = g
+    dv2 = multiply(r1,g,out=gradArray(out,3,v2.shape,v1.dtype))
+
+    da1 = g*wv.sum()
+    dv1 = gradArray(out,1,v1.shape,v1.dtype)
+    dot(S.reshape(n,-1),wv,out=dv1.reshape(n))
+    dv1 *= g
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate summed gradient of softplus model over a batch of samples
+def gradSPBatch(Y, # Observed responses
+                S, # Stimuli with sample number as first dimension
+                P, # Parameters
+                fused=False, # Also return responses and summed cost
+                out=None # Params to write gradient into
+                ):
+
+    # Extract parameters
+    a1,v1,J1,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dSP,dllike
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+    packed = J1.ndim == 1
+    if packed:
+        J = unpackSym(J1)
+    else:
+        J = J1.reshape(2*(v1.size,))
+
+    x1 = a1+matmul(v1.ravel(),S)+(matmul(J,S)*S).sum(1)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+matmul(r1,v2.ravel())
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = (dy*r2/d).sum().reshape(d.shape)
+
+    dyr = dy*dr2
+    da2 = dyr.sum().reshape(a2.shape)
+    dv2 = matmul(dyr,r1).reshape(v2.shape)
+
+    # Weight of each sample and grid location in first layer gradients
+    w = dyr.reshape(-1,1)*dr1*v2.ravel()
+
+    da1 = w.sum().reshape(a1.shape)
+    dv1 = tdot(S,w,((0,2),(0,1))).reshape(v1.shape)
+    dJ1 = tdot(S*w.reshape(w.shape[:1]+(1,)+w.shape[1:]),S,((0,2),(0,2)))
+    if packed:
+        dJ1 = packSym(dJ1)
+    else:
+        dJ1.shape = J1.shape
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dJ1,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate summed gradient of linear softplus model over a batch of samples
+def gradLinearSPBatch(Y, # Observed responses
+                      S, # Stimuli with sample number as first dimension
+                      P, # Parameters
+                      fused=False, # Also return responses and summed cost
+                      out=None # Params to write gradient into
+                      ):
+
+    # Extract parameters
+    a1,v1,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dSP,dllike
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    x1 = a1+matmul(v1.ravel(),S)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+matmul(r1,v2.ravel())
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = (dy*r2/d).sum().reshape(d.shape)
+
+    dyr = dy*dr2
+    da2 = dyr.sum().reshape(a2.shape)
+    dv2 = matmul(dyr,r1).reshape(v2.shape)
+
+    # Weight of each sample and grid location in first layer gradients
+    w = dyr.reshape(-1,1)*dr1*v2.ravel()
+
+    da1 = w.sum().reshape(a1.shape)
+    dv1 = tdot(S,w,((0,2),(0,1))).reshape(v1.shape)
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate summed gradient of logistic model over a batch of samples
+def gradLog2Batch(Y, # Observed responses
+                  S, # Stimuli with sample number as first dimension
+                  P, # Parameters
+                  fused=False, # Also return responses and summed cost
+                  out=None # Params to write gradient into
+                  ):
+
+    # Extract parameters
+    a1,v1,J1,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dlog,dllike
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+    packed = J1.ndim == 1
+    if packed:
+        J = unpackSym(J1)
+    else:
+        J = J1.reshape(2*(v1.size,))
+
+    x1 = a1+matmul(v1.ravel(),S)+(matmul(J,S)*S).sum(1)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+matmul(r1,v2.ravel())
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = (dy*r2/d).sum().reshape(d.shape)
+
+    dyr = dy*dr2
+    da2 = dyr.sum().reshape(a2.shape)
+    dv2 = matmul(dyr,r1).reshape(v2.shape)
+
+    # Weight of each sample and grid location in first layer gradients
+    w = dyr.reshape(-1,1)*dr1*v2.ravel()
+
+    da1 = w.sum().reshape(a1.shape)
+    dv1 = tdot(S,w,((0,2),(0,1))).reshape(v1.shape)
+    dJ1 = tdot(S*w.reshape(w.shape[:1]+(1,)+w.shape[1:]),S,((0,2),(0,2)))
+    if packed:
+        dJ1 = packSym(dJ1)
+    else:
+        dJ1.shape = J1.shape
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dJ1,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate summed gradient of linear logistic model over a batch of samples
+def gradLinearLog2Batch(Y, # Observed responses
+                        S, # Stimuli with sample number as first dimension
+                        P, # Parameters
+                        fused=False, # Also return responses and summed cost
+                        out=None # Params to write gradient into
+                        ):
+
+    # Extract parameters
+    a1,v1,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dlog,dllike
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    x1 = a1+matmul(v1.ravel(),S)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+matmul(r1,v2.ravel())
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = (dy*r2/d).sum().reshape(d.shape)
+
+    dyr = dy*dr2
+    da2 = dyr.sum().reshape(a2.shape)
+    dv2 = matmul(dyr,r1).reshape(v2.shape)
+
+    # Weight of each sample and grid location in first layer gradients
+    w = dyr.reshape(-1,1)*dr1*v2.ravel()
+
+    da1 = w.sum().reshape(a1.shape)
+    dv1 = tdot(S,w,((0,2),(0,1))).reshape(v1.shape)
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate gradient for low-rank softplus model
+# The quadratic filter is J = sum_k w[k]*U[k]*U[k].T
+def gradLowRankSP(Y, # Observed response
+                  S, # Stimulus
+                  P, # Parameters
+                  fused=False, # Also return response and cost
+                  out=None # Params to write gradient into
+                  ):
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dSP,dllike
+
+    Sf = S.reshape(v1.size,-1)
+    US = dot(U.reshape(w.size,-1),Sf)
+
+    x1 = a1+dot(v1.ravel(),Sf)+dot(w,US**2)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+(r1*v2.ravel()).sum()
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = dy*r2/d
+
+    g = dy*dr2
+    da2 = g
+    dv2 = multiply(r1.reshape(v2.shape),g,out=gradArray(out,5,v2.shape,v1.dtype))
+
+    # Weight of each grid location in first layer gradients
+    wg = g*dr1*v2.ravel()
+
+    da1 = wg.sum().reshape(a1.shape)
+    dv1 = gradArray(out,1,v1.shape,v1.dtype)
+    dot(Sf,wg,out=dv1.reshape(-1))
+    dU = gradArray(out,2,U.shape,v1.dtype)
+    dUf = dU.reshape(w.size,-1)
+    dot(US*wg,Sf.T,out=dUf)
+    dUf *= 2*w.reshape(-1,1)
+    dw = dot(US**2,wg,out=gradArray(out,3,w.shape,v1.dtype))
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dU,dw,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate gradient for low-rank logistic model
+# The quadratic filter is J = sum_k w[k]*U[k]*U[k].T
+def gradLowRankLog2(Y, # Observed response
+                    S, # Stimulus
+                    P, # Parameters
+                    fused=False, # Also return response and cost
+                    out=None # Params to write gradient into
+                    ):
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dlog,dllike
+
+    Sf = S.reshape(v1.size,-1)
+    US = dot(U.reshape(w.size,-1),Sf)
+
+    x1 = a1+dot(v1.ravel(),Sf)+dot(w,US**2)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+(r1*v2.ravel()).sum()
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = dy*r2/d
+
+    g = dy*dr2
+    da2 = g
+    dv2 = multiply(r1.reshape(v2.shape),g,out=gradArray(out,5,v2.shape,v1.dtype))
+
+    # Weight of each grid location in first layer gradients
+    wg = g*dr1*v2.ravel()
+
+    da1 = wg.sum().reshape(a1.shape)
+    dv1 = gradArray(out,1,v1.shape,v1.dtype)
+    dot(Sf,wg,out=dv1.reshape(-1))
+    dU = gradArray(out,2,U.shape,v1.dtype)
+    dUf = dU.reshape(w.size,-1)
+    dot(US*wg,Sf.T,out=dUf)
+    dUf *= 2*w.reshape(-1,1)
+    dw = dot(US**2,wg,out=gradArray(out,3,w.shape,v1.dtype))
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dU,dw,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate summed gradient of low-rank softplus model over a batch of samples
+def gradLowRankSPBatch(Y, # Observed responses
+                       S, # Stimuli with sample number as first dimension
+                       P, # Parameters
+                       fused=False, # Also return responses and summed cost
+                       out=None # Params to write gradient into
+                       ):
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dSP,dllike
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+    US = matmul(U.reshape(w.size,-1),S)
+
+    x1 = a1+matmul(v1.ravel(),S)+matmul(w,US**2)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+matmul(r1,v2.ravel())
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = (dy*r2/d).sum().reshape(d.shape)
+
+    dyr = dy*dr2
+    da2 = dyr.sum().reshape(a2.shape)
+    dv2 = matmul(dyr,r1).reshape(v2.shape)
+
+    # Weight of each sample and grid location in first layer gradients
+    wg = dyr.reshape(-1,1)*dr1*v2.ravel()
+    wg.shape = wg.shape[:1]+(1,)+wg.shape[1:]
+
+    da1 = wg.sum().reshape(a1.shape)
+    dv1 = (S*wg).sum(2).sum(0).reshape(v1.shape)
+    dU = 2*w.reshape(-1,1)*tdot(US*wg,S,((0,2),(0,2)))
+    dU.shape = U.shape
+    dw = (US**2*wg).sum(2).sum(0)
+
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dU,dw,da2,dv2,dd],out,Y,d*r2,fused)
+
+# Calculate summed gradient of low-rank logistic model over a batch of samples
+def gradLowRankLog2Batch(Y, # Observed responses
+                         S, # Stimuli with sample number as first dimension
+                         P, # Parameters
+                         fused=False, # Also return responses and summed cost
+                         out=None # Params to write gradient into
+                         ):
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    # Derivatives of model nonlinearities and cost function
+    df1,df2,dfe = dlog,dlog,dllike
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+    US = matmul(U.reshape(w.size,-1),S)
+
+    x1 = a1+matmul(v1.ravel(),S)+matmul(w,US**2)
+    r1 = f1(x1)
+    dr1 = df1(x1)
+    x2 = a2+matmul(r1,v2.ravel())
+    r2 = f2(x2)
+    dr2 = df2(x2)
+
+    dy = d*dfe(Y,d*r2)
+    dd = (dy*r2/d).sum().reshape(d.shape)
+
+    dyr = dy*dr2
+    da2 = dyr.sum().reshape(a2.shape)
+    dv2 = matmul(dyr,r1).reshape(v2.shape)
+
+    # Weight of each sample and grid location in first layer gradients
+    wg = dyr.reshape(-1,1)*dr1*v2.ravel()
+    wg.shape = wg.shape[:1]+(1,)+wg.shape[1:]
 
-    da1 = dy*dr2*(dr1*v2).sum()
-    dv1 = dy*dr2*tdot(dr1*S,v2,(list(range(-ndim,0)),list(range(ndim))))
+    da1 = wg.sum().reshape(a1.shape)
+    dv1 = (S*wg).sum(2).sum(0).reshape(v1.shape)
+    dU = 2*w.reshape(-1,1)*tdot(US*wg,S,((0,2),(0,2)))
+    dU.shape = U.shape
+    dw = (US**2*wg).sum(2).sum(0)
 
-    return Params([da1,dv1,da2,dv2,dd])
\ No newline at end of file
+    # Return gradient, and model response and cost computed in the same pass
+    return gradResult([da1,dv1,dU,dw,da2,dv2,dd],out,Y,d*r2,fused)
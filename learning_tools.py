@@ -1,10 +1,18 @@
+from numpy import sqrt, multiply, divide, empty_like, dot, array_equal
+from numpy import zeros_like, finfo, ndarray
+from Params import Params
 
 """
 LearningRate class to adjust learning rate
 Base class keeps learning rate constant unless training error increases.
+step applies a gradient step to the parameters in place.
 """
 class LearningRate(object):
 
+    # Whether steps are taken with stepFull on the full training set instead
+    # of step on each batch
+    fullBatch = False
+
     def __init__(self,
                  initialError, # Initial training error
                  initialRate = 1e-4, # Initial learning rate
@@ -23,6 +31,48 @@ class LearningRate(object):
         else:
             self.lrate *= self.lrDown
 
+    # Adds gradient G times learning rate to Params P in place
+    def step(self,P,G):
+
+        P.axpy(self.lrate,G)
+
+    # Returns the attributes of the rule as a dictionary of values that can
+    # be saved as JSON and a dictionary of the arrays they refer to, so that
+    # checkpoints hold its buffers without pickling it. Arrays, Params, and
+    # lists of arrays are replaced in the values by the names of their
+    # arrays.
+    def getState(self):
+
+        values = {}
+        arrays = {}
+        for k,v in self.__dict__.items():
+            if isinstance(v,Params):
+                arrays[k] = v.buffer
+                values[k] = {'params':k,'shapes':v.shapes}
+            elif isinstance(v,ndarray):
+                arrays[k] = v
+                values[k] = {'array':k}
+            elif isinstance(v,list):
+                names = ['%s_%u' % (k,j) for j in range(len(v))]
+                arrays.update(zip(names,v))
+                values[k] = {'arrays':names}
+            else:
+                values[k] = v
+
+        return values,arrays
+
+    # Restores attributes saved by getState
+    def setState(self,values,arrays):
+
+        for k,v in values.items():
+            if isinstance(v,dict) and 'params' in v:
+                v = Params(arrays[v['params']],v['shapes'])
+            elif isinstance(v,dict) and 'array' in v:
+                v = arrays[v['array']]
+            elif isinstance(v,dict):
+                v = [arrays[name] for name in v['arrays']]
+            setattr(self,k,v)
+
 # Learning rate decays as l0/(1+its/tau)
 # Decreases l0 if training error increases
 class DecayRate(LearningRate):
@@ -78,3 +128,360 @@ class BoldDriver(LearningRate):
             self.lastError = error
         else:
             self.lrate *= self.lDown
+
+# Gradient steps accumulate in a velocity that decays by momentum each step.
+# Learning rate decreases and velocity is reset if training error increases.
+class Momentum(LearningRate):
+
+    def __init__(self,
+                 initialError, # Initial training error
+                 initialRate = 1e-4, # Initial learning rate
+                 momentum = 0.9, # Fraction of velocity kept each step
+                 lrDown = 0.1, # Learning rate multiplied by this factor if error increases
+                 **kwargs):
+
+        LearningRate.__init__(self,initialError,initialRate,lrDown)
+        self.momentum = momentum
+        self.velocity = None
+
+    # Checks training error. If it has increased, decreases learning rate and
+    # resets velocity
+    def update(self,error,*args,**kwargs):
+
+        if error >= self.lastError and self.velocity is not None:
+            self.velocity *= 0.
+        LearningRate.update(self,error)
+
+    # Adds gradient G times learning rate to velocity and velocity to P
+    def step(self,P,G):
+
+        if self.velocity is None:
+            self.velocity = G*0.
+        self.velocity *= self.momentum
+        self.velocity.axpy(self.lrate,G)
+        P += self.velocity
+
+# Gradient steps are divided by the root of a running average of the squared
+# gradient of each parameter. Learning rate decreases if training error
+# increases.
+class RMSProp(LearningRate):
+
+    def __init__(self,
+                 initialError, # Initial training error
+                 initialRate = 1e-3, # Initial learning rate
+                 decay = 0.9, # Fraction of average of squared gradient kept each step
+                 epsilon = 1e-8, # Added to root of average to avoid dividing by zero
+                 lrDown = 0.1, # Learning rate multiplied by this factor if error increases
+                 **kwargs):
+
+        LearningRate.__init__(self,initialError,initialRate,lrDown)
+        self.decay = decay
+        self.epsilon = epsilon
+        self.meanSquare = None
+        self.scratch = None
+
+    # Updates average of squared gradient and adds scaled gradient to P
+    def step(self,P,G):
+
+        if self.meanSquare is None:
+            self.meanSquare = G*0.
+            self.scratch = empty_like(G.buffer)
+        g,ms,x = G.buffer,self.meanSquare.buffer,self.scratch
+
+        multiply(g,g,out=x)
+        x *= 1-self.decay
+        ms *= self.decay
+        ms += x
+
+        sqrt(ms,out=x)
+        x += self.epsilon
+        divide(g,x,out=x)
+        x *= self.lrate
+        P.buffer += x
+
+# Gradient steps use running averages of the gradient and its square with
+# bias correction (Adam). Learning rate decreases and the average gradient is
+# reset if training error increases.
+class Adam(LearningRate):
+
+    def __init__(self,
+                 initialError, # Initial training error
+                 initialRate = 1e-3, # Initial learning rate
+                 beta1 = 0.9, # Fraction of average gradient kept each step
+                 beta2 = 0.999, # Fraction of average of squared gradient kept each step
+                 epsilon = 1e-8, # Added to root of average to avoid dividing by zero
+                 lrDown = 0.1, # Learning rate multiplied by this factor if error increases
+                 **kwargs):
+
+        LearningRate.__init__(self,initialError,initialRate,lrDown)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.steps = 0
+        self.mean = None
+        self.meanSquare = None
+        self.scratch = None
+
+    # Checks training error. If it has increased, decreases learning rate and
+    # resets average gradient
+    def update(self,error,*args,**kwargs):
+
+        if error >= self.lastError and self.mean is not None:
+            self.mean *= 0.
+        LearningRate.update(self,error)
+
+    # Updates averages and adds bias corrected step to P
+    def step(self,P,G):
+
+        if self.mean is None:
+            self.mean = G*0.
+            self.meanSquare = G*0.
+            self.scratch = empty_like(G.buffer)
+        g,m,ms,x = G.buffer,self.mean.buffer,self.meanSquare.buffer,self.scratch
+        self.steps += 1
+
+        m *= self.beta1
+        multiply(g,1-self.beta1,out=x)
+        m += x
+
+        ms *= self.beta2
+        multiply(g,g,out=x)
+        x *= 1-self.beta2
+        ms += x
+
+        # Bias corrections of both averages are folded into the step size
+        sqrt(ms,out=x)
+        x *= 1./sqrt(1-self.beta2**self.steps)
+        x += self.epsilon
+        divide(m,x,out=x)
+        x *= self.lrate/(1-self.beta1**self.steps)
+        P.buffer += x
+
+# Base class of full batch rules. Keeps the cost and gradient of the last
+# accepted parameters and does backtracking line searches on the cost.
+class FullBatchRate(LearningRate):
+
+    fullBatch = True
+
+    def __init__(self,
+                 initialError, # Initial training error
+                 initialRate = 1., # Learning rate
+                 armijo = 1e-4, # Fraction of decrease expected from the gradient a step must achieve
+                 maxSearch = 20, # Maximum number of step lengths tried by the line search
+                 lrDown = 0.1, # Learning rate multiplied by this factor if error does not decrease
+                 **kwargs):
+
+        LearningRate.__init__(self,initialError,initialRate,lrDown)
+        self.armijo = armijo
+        self.maxSearch = maxSearch
+        self.reset()
+
+    # Clears the cached cost and gradient
+    def reset(self):
+
+        self.x = None
+        self.f = None
+        self.g = None
+
+    # Checks training error. If it has not decreased, decreases learning rate
+    # and clears cached values.
+    def update(self,error,*args,**kwargs):
+
+        if not error < self.lastError:
+            self.reset()
+        LearningRate.update(self,error)
+
+    # Returns P as a vector with the cost and gradient of the cost at P,
+    # kept from the last step if P has not changed
+    def evaluate(self,P,func):
+
+        if self.x is None or not array_equal(self.x,P.buffer):
+            self.reset()
+            f,G = func(P)
+            self.x,self.f,self.g = P.buffer.copy(),f,-G.buffer
+
+        return self.x,self.f,self.g
+
+    # Moves P from x along d, halving the step length from t until the cost
+    # decreases enough. Returns the step length, new cost, and gradient of
+    # the cost, or None if no step decreased the cost, leaving P at x.
+    def lineSearch(self,P,func,x,f,g,d,t=1.):
+
+        slope = dot(g,d)
+        for j in range(self.maxSearch):
+            P.buffer[:] = x+t*d
+            fNew,G = func(P)
+            if fNew <= f+self.armijo*t*slope:
+                gNew = -G.buffer
+                self.x,self.f,self.g = P.buffer.copy(),fNew,gNew
+                return t,fNew,gNew
+            t *= 0.5
+
+        P.buffer[:] = x
+
+        return None
+
+# Full batch limited memory BFGS. Each step computes a search direction from
+# the last memory changes of the parameters and gradient and moves along it
+# with a backtracking line search on the cost. Learning rate is the initial
+# step length when there is no history. It decreases and the history is
+# cleared if training error does not decrease, which happens when the line
+# search fails.
+class LBFGS(FullBatchRate):
+
+    def __init__(self,
+                 initialError, # Initial training error
+                 initialRate = 1e-1, # Length of first step
+                 memory = 10, # Number of changes used to approximate the Hessian
+                 armijo = 1e-4, # Fraction of decrease expected from the gradient a step must achieve
+                 maxSearch = 20, # Maximum number of step lengths tried by the line search
+                 lrDown = 0.1, # Learning rate multiplied by this factor if error does not decrease
+                 **kwargs):
+
+        self.memory = memory
+        FullBatchRate.__init__(self,initialError,initialRate,armijo,maxSearch,lrDown)
+
+    # Clears history and the cached cost and gradient
+    def reset(self):
+
+        FullBatchRate.reset(self)
+        self.S = []
+        self.Y = []
+
+    # Search direction from gradient of cost g by the two loop recursion
+    def direction(self,g):
+
+        if not self.S:
+            return -g*(self.lrate/sqrt(dot(g,g)))
+
+        q = -g
+        alpha = []
+        for s,y in zip(reversed(self.S),reversed(self.Y)):
+            a = dot(s,q)/dot(y,s)
+            q -= a*y
+            alpha.append(a)
+        q *= dot(self.S[-1],self.Y[-1])/dot(self.Y[-1],self.Y[-1])
+        for s,y,a in zip(self.S,self.Y,reversed(alpha)):
+            q += (a-dot(y,q)/dot(y,s))*s
+
+        return q
+
+    """
+    Takes one step, changing P in place.
+    Inputs:
+        P: Params to optimize
+        func: func(P) returns the mean cost and the Params of the mean
+            gradient step direction (negative gradient of the cost) at P
+    Returns cost at the new P.
+    """
+    def stepFull(self,P,func):
+
+        x,f,g = self.evaluate(P,func)
+
+        d = self.direction(g)
+        if not dot(g,d) < 0:
+            self.S,self.Y = [],[]
+            d = self.direction(g)
+
+        step = self.lineSearch(P,func,x,f,g,d)
+        if step is None:
+            return f
+
+        gNew = step[2]
+        s,y = P.buffer-x,gNew-g
+        if dot(s,y) > 0:
+            self.S.append(s)
+            self.Y.append(y)
+            if len(self.S) > self.memory:
+                self.S.pop(0)
+                self.Y.pop(0)
+
+        return step[1]
+
+# Full batch truncated Newton (Hessian free). Each step solves
+# (H+damping*I)*d = -g by conjugate gradient, where products with the Hessian
+# H are finite differences of the gradient, then moves along d with a
+# backtracking line search starting from the learning rate. Damping adapts to
+# how well the quadratic model predicted the decrease of the cost. Learning
+# rate decreases if training error does not decrease, which happens when the
+# line search fails.
+class HessianFree(FullBatchRate):
+
+    def __init__(self,
+                 initialError, # Initial training error
+                 initialRate = 1., # Initial length of each step along the Newton direction
+                 damping = 1., # Initial damping added to the Hessian
+                 maxCG = 20, # Maximum number of conjugate gradient iterations
+                 tolCG = 1e-2, # Conjugate gradient stops when residual falls below tolCG times gradient
+                 armijo = 1e-4, # Fraction of decrease expected from the gradient a step must achieve
+                 maxSearch = 20, # Maximum number of step lengths tried by the line search
+                 lrDown = 0.1, # Learning rate multiplied by this factor if error does not decrease
+                 **kwargs):
+
+        FullBatchRate.__init__(self,initialError,initialRate,armijo,maxSearch,lrDown)
+        self.damping = damping
+        self.maxCG = maxCG
+        self.tolCG = tolCG
+
+    # Product of damped Hessian at x with v, from the gradient at x+h*v
+    def hessVec(self,P,func,x,g,v):
+
+        h = sqrt(finfo(x.dtype).eps)*(1+sqrt(dot(x,x)))/sqrt(dot(v,v))
+        P.buffer[:] = x+h*v
+        Hv = (-func(P)[1].buffer-g)/h
+        Hv += self.damping*v
+
+        return Hv
+
+    """
+    Takes one step, changing P in place.
+    Inputs:
+        P: Params to optimize
+        func: func(P) returns the mean cost and the Params of the mean
+            gradient step direction (negative gradient of the cost) at P
+    Returns cost at the new P.
+    """
+    def stepFull(self,P,func):
+
+        x,f,g = self.evaluate(P,func)
+
+        # Conjugate gradient, stopping early at directions of negative
+        # curvature. dHd is d*(H+damping*I)*d for the final d.
+        d = zeros_like(g)
+        r = -g
+        p = r.copy()
+        rr = dot(r,r)
+        for j in range(self.maxCG):
+            Hp = self.hessVec(P,func,x,g,p)
+            pHp = dot(p,Hp)
+            if not pHp > 0:
+                if j == 0:
+                    d = p
+                break
+            a = rr/pHp
+            d += a*p
+            r -= a*Hp
+            rrNew = dot(r,r)
+            if sqrt(rrNew) < self.tolCG*sqrt(dot(g,g)):
+                break
+            p *= rrNew/rr
+            p += r
+            rr = rrNew
+        dHd = -dot(d,g)-dot(d,r)
+        P.buffer[:] = x
+
+        step = self.lineSearch(P,func,x,f,g,d,self.lrate)
+        if step is None:
+            self.damping *= 1.5
+            return f
+
+        # Compare decrease with that predicted by the quadratic model
+        t,fNew = step[:2]
+        predicted = t*dot(g,d)+0.5*t*t*dHd
+        rho = (fNew-f)/predicted if predicted < 0 else 0.
+        if rho < 0.25:
+            self.damping *= 1.5
+        elif rho > 0.75:
+            self.damping /= 1.5
+
+        return fNew
@@ -1,9 +1,15 @@
-from numpy import array, log, exp, spacing
+from numpy import array, log, exp, spacing, sqrt, empty, triu_indices, finfo, float64
 
-# Small number
-eps = spacing(1.)
+# Small number (Python float so it does not promote float32 arrays)
+eps = float(spacing(1.))
 
 
+# Largest argument for which exp does not overflow (700 for float64)
+def expLimit(dtype):
+    if finfo(dtype).bits < 64:
+        return 0.98*log(finfo(dtype).max)
+    return 700
+
 # Soft-rectifier (log(1+exp(x)))
 def softPlus(x):
 
@@ -11,10 +17,11 @@ def softPlus(x):
     r = array(x)
 
     # If exp(r) would overflow, treat softPlus(r) as linear
+    lim = expLimit(r.dtype)
     if r.ndim:
-        r[r<700] = log(1+exp(r[r<700]))
+        r[r<lim] = log(1+exp(r[r<lim]))
     else:
-        if r < 700:
+        if r < lim:
             r = log(1+exp(r))
 
     return r
@@ -40,10 +47,45 @@ def dlog(x):
 
 # Poisson log likelihood
 # Returns difference between likelihood of predictions and observations in order
-# to make value positive
+# to make value positive. The mean is accumulated in float64.
 def llike(Y,R):
-    return (Y*log(Y+eps)-Y-Y*log(R+eps)+R).mean()
+    return llikes(Y,R).mean(dtype=float64)
+
+# Poisson log likelihood of each observation
+def llikes(Y,R):
+    return Y*log(Y+eps)-Y-Y*log(R+eps)+R
 
 # Derivative of poisson log-likelihood
 def dllike(Y,R):
-    return Y/(R+eps)-1
\ No newline at end of file
+    return Y/(R+eps)-1
+
+# Indices of upper triangle of n x n matrices, cached by n
+triuIndices = {}
+def triuInd(n):
+    if n not in triuIndices:
+        triuIndices[n] = triu_indices(n)
+    return triuIndices[n]
+
+# Indices of the upper triangle in a flattened n x n matrix, and of the
+# mirrored lower triangle, cached by n. Flat indices are faster to scatter
+# and gather than pairs of row and column indices.
+triuFlatIndices = {}
+def triuFlatInd(n):
+    if n not in triuFlatIndices:
+        i,j = triuInd(n)
+        triuFlatIndices[n] = (i*n+j,j*n+i)
+    return triuFlatIndices[n]
+
+# Pack symmetric matrix into vector of its upper triangle, written into out
+# if given
+def packSym(J,out=None):
+    return J.reshape(-1).take(triuFlatInd(J.shape[0])[0],out=out)
+
+# Unpack vector of upper triangle into full symmetric matrix
+def unpackSym(Jp):
+    n = int(round((sqrt(8*Jp.size+1)-1)/2))
+    upper,lower = triuFlatInd(n)
+    J = empty(n*n,dtype=Jp.dtype)
+    J[upper] = Jp
+    J[lower] = Jp
+    return J.reshape(n,n)
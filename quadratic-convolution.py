@@ -1,11 +1,21 @@
-from numpy import zeros,ones,delete,dot,arange
-from numpy import prod,fromfile,inf
-from numpy.linalg import norm,inv
+from numpy import zeros,ones,delete,dot,arange,isin,matmul,float64,int64
+from numpy import prod,fromfile,inf,sort
+from numpy import dtype as dtype_
+from numpy.linalg import norm,inv,eigh
 from sys import stdout
 from os import remove
 from os.path import exists,expanduser,isdir
 from time import time
 from numpy.random import RandomState
+from numpy import ndarray as ndarray_
+from numpy import memmap
+from mmap import mmap
+from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from numpy import savez,frombuffer,uint8
+from numpy import load as loadNumpy
+import json
+from io import BytesIO
 
 NumType = (int,int,float)
 
@@ -13,24 +23,65 @@ NumType = (int,int,float)
 from response_functions import *
 from utils import *
 from learning_tools import *
+from convolution import fftFaster, eigParams, respSPFFT, respLog2FFT
+from file_tools import BackgroundWriter
+
+"""
+Divides samples into training and validation sets.
+Inputs:
+    Nsamples: Number of samples (stimulus frames minus nlags-1)
+    jack, Njack, nlags, perm, splits: As in fitModel
+Returns indices of training samples and validation samples.
+"""
+def splitSets(Nsamples,jack,Njack,nlags,perm=True,splits=None):
+
+    Nvalid = Nsamples // Njack
+
+    # Randomly permute stimulus and spikes
+    if isinstance(perm,ndarray):
+        assert perm.size == Nsamples
+        p = perm[nlags-1:]
+    elif perm:
+        RS = RandomState(0)
+        p = RS.permutation(Nsamples-nlags+1)
+    else:
+        p = arange(Nsamples-nlags+1)
+
+    # Split data into training and test sets
+    validslice = slice((jack-1)*Nvalid,jack*Nvalid)
+    pv = p[validslice]
+    pr = delete(p,validslice)
+
+    # Remove samples that span recordings from training and validation sets
+    if splits is not None:
+        invalid = array([arange(sp-nlags+1,sp) for sp in splits]).flatten()
+        pv = pv[~isin(pv,invalid)]
+        pr = pr[~isin(pr,invalid)]
+
+    return pr,pv
 
 """
 This function either initializes the model or loads previous run and fits it
 with the given stimuli and responses. Outputs file with best parameters on
 training set, file with best parameters on validation set, file with training
-error history, and file with validation error history. Also creates status
-file used to restart incomplete runs that is deleted when the fit converges.
+error history, file with validation error history, and file with the
+iteration of each validation error. Also creates status file used to restart
+incomplete runs that is deleted when the fit converges.
 Inputs:
     prefix: String appended to all output files
     spikes: numpy array of responses to predict
     stim: numpy array of stimuli. The last dimension is the sample number.
+        Can also be a numpy.memmap, a path to a .npy file, or a list of paths
+        to .npy files with consecutive chunks of frames (see openStim). These
+        are read from disk as needed and normalized one batch at a time.
     jack: Jackknife used for validation. From 1 to Njack
     fsize: tuple with shape of the first layer's filter size
     extrapSteps: Number of steps used to estimate slope of validation error
     pixelNorm: Whether to normalize using local statistics (if True) or global
-        (if False)
+        (if False). If None, stim is already normalized and is not modified.
     filepath: Path where to save output files
-    model: Type of model to fit
+    model: Type of model to fit. The lowRank models replace the quadratic
+        filter J with sum_k w[k]*U[k]*U[k].T.
     maxIts: Maximum number of iterations to run
     maxHours: Maximum number of hours to run
     perm: Whether to randomly permute stimulus-response pairs before divinding
@@ -48,19 +99,118 @@ Inputs:
     splits: Locations of splits in the stimuli/responses. Used for nlags > 1 so
         that stimuli from one recording aren't used to predict responses for
         the next recording.
-    LRType: Learning rate rule used.
+    rank: Number of terms in the quadratic filter of lowRank models.
+    packJ: If True, store only the upper triangle of the symmetric quadratic
+        filter J of the softplus and logistic models.
+    engine: How responses are evaluated when calculating errors. 'direct'
+        takes the dot product with the patch at each grid location, 'fft'
+        correlates the filters with the stimulus using FFTs, and 'auto' picks
+        whichever is estimated to be faster for the patch and grid sizes.
+    loadSize: Number of training samples copied into a contiguous array at
+        once during training. Rounded up to whole batches, and reduced to
+        fit chunkElements.
+    shuffle: If True, the order of the training samples is randomly permuted
+        every iteration. Otherwise they are visited in the same order.
+    prefetch: If True, the next chunk of training samples is copied in a
+        background thread, during training and initialization. Useful when
+        reading the stimulus from disk.
+    dtype: Floating point type of the stimulus, responses, and parameters
+        used for training (e.g. float32 to halve memory traffic). Costs are
+        accumulated in float64.
+    LRType: Learning rate rule used: 'DecayRate', 'BoldDriver', or
+        'LearningRate' for plain gradient steps, or 'Momentum', 'RMSProp', or
+        'Adam' for steps using running averages of the gradient (see
+        learning_tools). Their state is saved in checkpoints. 'LBFGS' and
+        'HessianFree' instead take one full batch L-BFGS or truncated Newton
+        step per iteration, with a line search on the training cost.
     LRParams: Parameters for learning rate rule.
+    chunkSize: Number of samples evaluated at once when calculating errors
+        and the stimulus averages of the 'stim' and 'sta' initializations.
+    chunkElements: Maximum number of stimulus elements (patch size times
+        grid size per sample) in a chunk. Chunks of chunkSize or loadSize
+        samples are made smaller when they would exceed it, since every
+        sample holds the patch at every grid location.
+    batchSize: Number of training samples per parameter update. 1 gives
+        stochastic gradient descent. Larger batches sum the gradient over
+        the batch and apply it in one update.
+    trainErrFromPass: If True, the training error of each iteration is the
+        cost accumulated while updating the parameters, which skips the
+        separate evaluation of the model on the training set.
+    sets: Tuple of training and validation sample indices to use instead of
+        dividing the data with perm, jack, and splits (see splitSets).
+    trainErrSample: Number of training samples, or fraction of the training
+        set if a float no larger than 1 (1. for all of it), in a fixed
+        random subsample used to estimate the change of the training error
+        each iteration. The full training set is evaluated
+        only when the change is within trainErrConfidence standard errors
+        of zero. Otherwise the training error saved is the last one plus
+        the estimated change, so the logged and printed training errors may
+        be estimates. Ignored if trainErrFromPass is True or for full batch
+        learning rules.
+    trainErrConfidence: Number of standard errors the estimated change of
+        the training error must differ from zero to be used.
+    trainErrResync: Number of consecutive iterations with estimated training
+        errors after which the full training set is evaluated, so estimation
+        errors do not accumulate. The training error is also recalculated on
+        the full training set before each checkpoint.
+    validEvery: The validation error is calculated every validEvery
+        iterations that decrease the training error. The validation error
+        history file gets one entry per calculation, and the iteration of
+        each entry is written to the _errValidIts file (int64).
+    validBackground: If True, validation errors are calculated in a
+        background thread from a copy of the parameters while training
+        continues, and the slope is updated as they arrive. If a calculation
+        is requested while one is running, only the latest request is kept.
+        Checkpoints do not include calculations that have not finished.
+    cacheDir: If given, the normalized stimulus is stored in this directory
+        and read from it as a memmap by later fits with the same stimulus and
+        normalization (see StimCache).
+    cacheBytes: Maximum size of the stimulus cache. Least recently used
+        stimuli are removed when it is exceeded.
+    stimNorm: Tuple of the mean and stdev used to normalize stim if pixelNorm
+        is None. Only saved in the headers of the parameter files.
+    checkpointEvery: Number of iterations between checkpoints holding the
+        full state of the fit, from which an interrupted fit resumes as if
+        it had not stopped. Checkpoints are numpy .npz files of the arrays
+        of the state with a JSON header of its other values (see
+        loadCheckpoint). 0 disables checkpoints, in which case only the
+        iteration and validation minimum are saved, so an interrupted fit
+        resumes from its last saved parameters.
+    writeBackground: If True, parameter, error history, and checkpoint files
+        are written by a background thread while training continues. Only
+        the latest version of each parameter file is written if storage
+        falls behind.
 """
 def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
                 pixelNorm=True,filepath=None,model='softplus',
                 maxIts=None,maxHours=None,perm=True,overwrite=False,
-                Njack=4,start='rand_rand',nlags=1,splits=None,
-                LRType='DecayRate',LRParams = {}):
+                Njack=4,start='rand_rand',nlags=1,splits=None,rank=1,packJ=False,
+                engine='auto',loadSize=256,shuffle=False,prefetch=False,
+                dtype=float,
+                LRType='DecayRate',LRParams = {},chunkSize=1024,batchSize=1,
+                trainErrFromPass=False,sets=None,cacheDir=None,cacheBytes=None,
+                stimNorm=None,checkpointEvery=1,writeBackground=True,
+                trainErrSample=None,trainErrConfidence=3.,validEvery=1,
+                validBackground=False,chunkElements=2**22,trainErrResync=10):
 
 
     assert isinstance(prefix,str)
     print('Prefix ' + prefix)
 
+    # Use normalized stimulus from cache, normalizing it into the cache first
+    # if needed
+    if cacheDir is not None and pixelNorm is not None:
+        print('Stimulus cache ',cacheDir)
+        stim,stimAve,stimStDev = StimCache(cacheDir,cacheBytes,chunkSize).normalize(stim,pixelNorm,dtype)
+        stimNorm = (stimAve,stimStDev)
+        pixelNorm = None
+
+    # Open stimulus files as memmaps
+    stim = openStim(stim)
+    outOfCore = isinstance(stim,memmap)
+    if outOfCore:
+        print('Reading stimulus from disk')
+
     Njack = IntCheck(Njack)
     jack = IntCheck(jack)
     assert jack > 0 and jack <= Njack
@@ -77,33 +227,98 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
     ng = len(gsize)
     print('Grid size ',gsize)
 
-    assert model in ['softplus','linearSoftplus','logistic','linearLogistic']
+    assert model in ['softplus','linearSoftplus','logistic','linearLogistic',
+                     'lowRankSoftplus','lowRankLogistic']
     print('Model ',model)
+
+    # Models with a quadratic term in the first layer
+    quadratic = model not in ['linearSoftplus','linearLogistic']
+    lowRank = model in ['lowRankSoftplus','lowRankLogistic']
+    if lowRank:
+        rank = IntCheck(rank)
+        assert rank > 0 and rank <= prod(fsize)
+        print('Rank of quadratic filter ',rank)
+    packJ = packJ and quadratic and not lowRank
+    if packJ:
+        print('Storing upper triangle of quadratic filter')
+
     if model == 'softplus':
         resp = respSP
+        bresp = respSPBatch
+        fresp = respSPFFT
         grad = gradSP
+        bgrad = gradSPBatch
         cost = llike
+        costs = llikes
         AlgTag = '_QuadraticSoftPlus'
     elif model == 'linearSoftplus':
         resp = respLinearSP
+        bresp = respLinearSPBatch
+        fresp = respSPFFT
         grad = gradLinearSP
+        bgrad = gradLinearSPBatch
         cost = llike
+        costs = llikes
         AlgTag = '_LinearSoftPlus'
     elif model == 'logistic':
         resp = respLog2
+        bresp = respLog2Batch
+        fresp = respLog2FFT
         grad = gradLog2
+        bgrad = gradLog2Batch
         cost = llike
+        costs = llikes
         AlgTag = '_QuadraticLogistic'
     elif model == 'linearLogistic':
         resp = respLinearLog2
+        bresp = respLinearLog2Batch
+        fresp = respLog2FFT
         grad = gradLinearLog2
+        bgrad = gradLinearLog2Batch
         cost = llike
+        costs = llikes
         AlgTag = '_LinearLogistic'
+    elif model == 'lowRankSoftplus':
+        resp = respLowRankSP
+        bresp = respLowRankSPBatch
+        fresp = respSPFFT
+        grad = gradLowRankSP
+        bgrad = gradLowRankSPBatch
+        cost = llike
+        costs = llikes
+        AlgTag = '_LowRank%uSoftPlus' % (rank,)
+    elif model == 'lowRankLogistic':
+        resp = respLowRankLog2
+        bresp = respLowRankLog2Batch
+        fresp = respLog2FFT
+        grad = gradLowRankLog2
+        bgrad = gradLowRankLog2Batch
+        cost = llike
+        costs = llikes
+        AlgTag = '_LowRank%uLogistic' % (rank,)
+    if packJ:
+        AlgTag += 'Packed'
+
+    batchSize = IntCheck(batchSize)
+    assert batchSize > 0
+    print('Batch size ',batchSize)
+
+    if trainErrFromPass:
+        print('Estimating training error during parameter updates')
+    elif trainErrSample is not None:
+        print('Estimating change of training error from subsample of ',trainErrSample)
+        trainErrResync = IntCheck(trainErrResync)
+        print('Full training error every iterations ',trainErrResync)
 
     extrapSteps = IntCheck(extrapSteps)
     print('Steps used to estimate error slipe ',extrapSteps)
 
-    if pixelNorm:
+    dtype = dtype_(dtype)
+    print('Data type ',dtype)
+
+    if pixelNorm is None:
+        print('Stimulus already normalized')
+    elif pixelNorm:
         print('Normalizing by pixel statistics')
     else:
         print('Normalizing by global statistics')
@@ -165,7 +380,7 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
     Ntrials = stim.shape[-1]-nlags+1
 
     # Convert spikes from int
-    Y = spikes.astype(float)
+    Y = spikes.astype(dtype)
     del spikes
 
     # Drop spikes before first full stimulus
@@ -177,33 +392,58 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
     # Size of first layer input
     npix = prod(fsize)
 
-    # Convert stimulus to zero mean and unit stdev
-    stim = normStim(stim,pixelNorm)[0]
+    # Convert stimulus to zero mean and unit stdev. Stimuli on disk are
+    # normalized as samples are read.
+    if outOfCore:
+        if pixelNorm is None:
+            stimAve,stimStDev = 0.,1.
+        elif isinstance(pixelNorm,tuple):
+            stimAve,stimStDev = pixelNorm
+        else:
+            stimAve,stimStDev = stimStats(stim,pixelNorm)
+        if pixelNorm is not None:
+            stimNorm = (stimAve,stimStDev)
+    elif pixelNorm is None:
+        stim = stim.astype(dtype,copy=False)
+    else:
+        stim,stimAve,stimStDev = normStim(stim.astype(dtype,copy=False),pixelNorm)
+        stimNorm = (stimAve,stimStDev)
 
-    Nvalid = Ntrials / Njack
+    Nvalid = Ntrials // Njack
     Ntrials -= Nvalid
 
-    # Randomly permute stimulus and spikes
-    if isinstance(perm,ndarray):
-        assert perm.size == Ntrials+Nvalid
-        p = perm[nlags-1:]
-    elif perm:
-        RS = RandomState(0)
-        p = RS.permutation(Ntrials+Nvalid-nlags+1)
-
-    # Split data into training and test sets
-    validslice = slice((jack-1)*Nvalid,jack*Nvalid)
-    pv = p[validslice]
-    pr = delete(p,validslice)
-
-    # Remove samples that span recordings from training and validation sets
-    if splits is not None:
-        invalid = array([arange(sp-nlags+1,sp) for sp in splits]).flatten()
-        pv = array([pp for pp in pv if pp not in invalid])
-        pr = array([pp for pp in pr if pp not in invalid])
+    # Divide samples into training and validation sets
+    if sets is None:
+        pr,pv = splitSets(Ntrials+Nvalid,jack,Njack,nlags,perm,splits)
+    else:
+        pr,pv = sets
 
     # Extract stimulus at grid locations
     S = gridStim(stim,fsize,nlags)
+    if outOfCore:
+        S = NormView(S,stimAve,stimStDev,lambda s: gridStim(s,fsize,nlags),nlags,dtype)
+
+    # Select how responses are evaluated
+    assert engine in ['auto','direct','fft']
+    if engine == 'auto':
+        if lowRank:
+            nquad = rank
+        elif quadratic:
+            nquad = npix
+        else:
+            nquad = 0
+        engine = 'fft' if fftFaster(fsize,gsize,nquad) else 'direct'
+    print('Evaluating responses with %s engine' % (engine,))
+    if engine == 'fft':
+        SF = frameStim(stim,nlags)
+        if outOfCore:
+            SF = NormView(SF,stimAve,stimStDev,lambda s: frameStim(s,nlags),nlags,dtype)
+
+    # Calculate model responses for samples ind (all if None)
+    def evalResp(P,ind=None):
+        if engine == 'fft':
+            return BatchResp(SF,eigParams(P),fresp,ind,chunkSize,chunkElements)
+        return BatchResp(S,P,bresp,ind,chunkSize,chunkElements)
 
     # Divide responses into training and validation sets
     YR = Y[pr]
@@ -224,33 +464,80 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
     trainBestName = filepath+prefix+AlgTag+'_train_%u.dat' % (jack,)
     validBestName = filepath+prefix+AlgTag+'_valid_%u.dat' % (jack,)
     statusName = filepath+prefix+AlgTag+'_%u.temp' % (jack,)
+    checkpointName = filepath+prefix+AlgTag+'_%u.ckpt' % (jack,)
     errTrainName = filepath+prefix+AlgTag+'_errTrain_%u.dat' % (jack,)
     errValidName = filepath+prefix+AlgTag+'_errValid_%u.dat' % (jack,)
+    errValidItsName = filepath+prefix+AlgTag+'_errValidIts_%u.dat' % (jack,)
 
     # Calculate shapes of parameters
-    if model in ['softplus','logistic']:
+    if lowRank:
+        shapes = [(1,),fsize,(rank,)+fsize,(rank,),(1,),gsize,(1,)]
+    elif packJ:
+        shapes = [(1,),fsize,(npix*(npix+1)//2,),(1,),gsize,(1,)]
+    elif quadratic:
         shapes = [(1,),fsize,2*fsize,(1,),gsize,(1,)]
     else:
         shapes = [(1,),fsize,(1,),gsize,(1,)]
 
+    # Description of the model saved in the headers of the parameter files.
+    # The normalization statistics are None if stim was already normalized.
+    header = dict(model=model,algorithm=AlgTag.lstrip('_'),fsize=fsize,
+                  gsize=gsize,nlags=nlags,jack=jack,Njack=Njack,
+                  stimAve=None if stimNorm is None else stimNorm[0],
+                  stimStDev=None if stimNorm is None else stimNorm[1])
+
     # Check to see if previous run exists
-    if exists(statusName):
+    state = None
+    if exists(checkpointName):
+
+        stdout.write('Resuming from checkpoint\n')
+        stdout.flush()
+        state,stateArrays = loadCheckpoint(checkpointName)
+        its = state['its']
+        P = Params(stateArrays['P'],shapes,dtype)
+        PV = Params(stateArrays['PV'],shapes,dtype)
+        if its > maxIts:
+            maxIts += its
+        errValidMin = stateArrays['errValidMin']
+        errTrainLog = list(stateArrays['errTrainLog'])
+        errValidLog = list(stateArrays['errValidLog'])
+        errValidItsLog = list(stateArrays['errValidItsLog'])
+        errValidHist = list(zip(errValidItsLog,errValidLog))[-extrapSteps:]
+        errTrain = errTrainLog[-1]
+
+        # Discard output written after the checkpoint
+        P.save(trainBestName,**header)
+        PV.save(validBestName,**header)
+        with open(errTrainName,'wb') as f:
+            array(errTrainLog).tofile(f)
+        with open(errValidName,'wb') as f:
+            array(errValidLog).tofile(f)
+        with open(errValidItsName,'wb') as f:
+            array(errValidItsLog,dtype=int64).tofile(f)
+
+    # Resume run that only saved its status
+    elif exists(statusName):
 
         stdout.write('Loading previous run\n')
         stdout.flush()
         with open(statusName,'r') as f:
-            its = fromfile(f,count=1,dtype=int)
-            errValidMin = fromfile(f,count=1)
-        P = Params(trainBestName,shapes)
-        PV = Params(validBestName,shapes)
+            its = int(fromfile(f,count=1,dtype=int)[0])
+            errValidMin = fromfile(f,count=1)[0]
+        P = Params(trainBestName,shapes,dtype)
+        PV = Params(validBestName,shapes,dtype)
         if its > maxIts:
             maxIts += its
-        with open(errValidName,'r') as f:
-            errValidHist = list(fromfile(f))
-        if len(errValidHist) > extrapSteps:
-            errValidHist = errValidHist[-extrapSteps:]
-        with open(errTrainName,'r') as f:
-            errTrain = fromfile(f)[-1]
+        with open(errValidName,'rb') as f:
+            errValidLog = list(fromfile(f))
+        if exists(errValidItsName):
+            with open(errValidItsName,'rb') as f:
+                errValidItsLog = list(fromfile(f,dtype=int64))
+        else:
+            errValidItsLog = list(range(len(errValidLog)))
+        errValidHist = list(zip(errValidItsLog,errValidLog))[-extrapSteps:]
+        with open(errTrainName,'rb') as f:
+            errTrainLog = list(fromfile(f))
+        errTrain = errTrainLog[-1]
     else:
         if exists(trainBestName) and not overwrite:
             print('Output files exist')
@@ -258,20 +545,25 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
         else:
             # If start is a Params object, copy it
             if isinstance(start,Params):
-                P = start.copy()
+                P = start.astype(dtype)
             # If start is a list/tuple, reshape values and convert to Params
             elif isinstance(start,list) or isinstance(start,tuple):
                 assert len(start) == len(shapes)
                 for s,p in zip(shapes,start):
                     p.shape = s
-                P = Params(start,shapes)
+                P = Params(start,shapes,dtype)
             else:
+                # Chunks of training samples for initializing from the
+                # stimulus, copied in a background thread if prefetch is True
+                initLoader = BatchLoader(S,Y,pr,chunkLength(S,chunkSize,chunkElements),
+                                         None,prefetch)
+
                 # Initialize first layer randomly
                 if vstart == 'rand':
                     RS = RandomState()
                     v = RS.randn(npix).reshape(fsize)
                     v /= norm(v)
-                    if model in ['softplus','logistic']:
+                    if quadratic:
                         J = RS.randn(npix,npix)
                         J = J+J.T
                         J /= norm(J)
@@ -280,41 +572,44 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
                 # Initialize first layer with random stimuli from training set
                 elif vstart == 'stim':
                     RS = RandomState()
-                    v = zeros(fsize)
-                    for j in pr:
-                        r = RS.randn(NGRID).reshape(gsize)
-                        v += tdot(S[j,...],r,(list(range(-ng,0)),list(range(ng))))
+                    v = zeros(npix)
+                    if quadratic:
+                        J = zeros((npix,npix))
+                    for y,s in initLoader:
+                        X = s.reshape(len(y),npix,NGRID)
+                        v += tdot(X,RS.randn(len(y),NGRID),((0,2),(0,1)))
+                        if quadratic:
+                            r = RS.randn(len(y),1,NGRID)
+                            J += tdot(X*r,X,((0,2),(0,2)))
+                    v.shape = fsize
                     v /= norm(v)
-                    if model in ['softplus','logistic']:
-                        J = zeros(2*fsize)
-                        for j in pr:
-                            r = RS.randn(NGRID).reshape(gsize)
-                            J += tdot(S[j,...],S[j,...]*r,(list(range(-ng,0)),list(range(-ng,0))))
+                    if quadratic:
+                        J.shape = 2*fsize
                         J /= norm(J)
 
                 # Initialize first layer using STA/STC
                 elif vstart == 'sta':
-                    ES = zeros(fsize)
-                    ESY = zeros(fsize)
-                    if model in ['softplus','logistic']:
-                        ESS = zeros(fsize*2)
-                        ESSY = zeros(fsize*2)
-                    for pp in pr:
-                        SS = S[pp,...].sum(-1).sum(-1).sum(-1).sum(-1)
-                        ES += SS
-                        ESY += SS*Y[pp]
-                        if model in ['softplus','logistic']:
-                            SSS = SS*SS.reshape(SS.shape+4*(1,))
-                            ESS += SSS
-                            ESSY += SSS*Y[pp]
+                    ES = zeros(npix)
+                    ESY = zeros(npix)
+                    if quadratic:
+                        ESS = zeros((npix,npix))
+                        ESSY = zeros((npix,npix))
+                    for y,s in initLoader:
+                        SS = s.reshape(len(y),npix,NGRID).sum(-1,dtype=float64)
+                        ES += SS.sum(0)
+                        ESY += dot(y,SS)
+                        if quadratic:
+                            ESS += dot(SS.T,SS)
+                            ESSY += dot(SS.T*y,SS)
                     ES /= pr.size
                     ESY /= YR.sum()
-                    v = ESY - ES
+                    v = (ESY - ES).reshape(fsize)
                     v /= norm(v)
-                    if model in ['softplus','logistic']:
+                    if quadratic:
                         ESS /= pr.size
                         ESSY /= YR.sum()
-                        J = (ESSY-ESY*ESY.reshape(ESY.shape+4*(1,)))-(ESS-ES*ES.reshape(ES.shape+4*(1,)))
+                        J = (ESSY-ESY[:,None]*ESY)-(ESS-ES[:,None]*ES)
+                        J.shape = 2*fsize
                         J /= norm(J)
 
                 else:
@@ -322,7 +617,7 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
 
                 # Scale v and J.
                 v *= 0.1
-                if model in ['softplus','logistic']:
+                if quadratic:
                     J *= 0.1
 
                 # Initialize second layer randomly
@@ -340,60 +635,83 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
 
                 # Intialize second layer using STA
                 elif bstart == 'sta':
-                    ES = zeros(gsize)
-                    ESY = zeros(gsize)
-                    for pp in pr:
-                        xv = tdot(S[pp,...],v,2*(list(range(4)),))
-                        xJ = (tdot(J,S[pp,...],2*(list(range(4)),))*S[pp,...]).sum(0).sum(0).sum(0).sum(0)
-                        r1 = logistic(xv+xJ)
-                        ES += r1
-                        ESY += r1*Y[pp]
+                    ES = zeros(NGRID)
+                    ESY = zeros(NGRID)
+                    for y,s in initLoader:
+                        X = s.reshape(len(y),npix,NGRID)
+                        x = matmul(v.ravel(),X)
+                        if quadratic:
+                            x += (matmul(J.reshape(npix,npix).T,X)*X).sum(1)
+                        r1 = logistic(x)
+                        ES += r1.sum(0)
+                        ESY += dot(y,r1)
                     ES /= pr.size
                     ESY /= YR.sum()
-                    v2 = ESY-ES
+                    v2 = (ESY-ES).reshape(gsize)
                     v2 /= norm(v2)
                     v2 *= 0.1
 
+                # Keep the rank largest magnitude eigenvectors of J
+                if lowRank:
+                    lam,vec = eigh(J.reshape(npix,npix))
+                    ind = abs(lam).argsort()[::-1][:rank]
+                    w = lam[ind]
+                    U = vec[:,ind].T.reshape((rank,)+fsize)
+
+                # Keep upper triangle of J
+                if packJ:
+                    J = packSym(J.reshape(npix,npix))
+
                 # Combine intialized parameters into a Params object
-                if model in ['softplus','logistic']:
+                if lowRank:
+                    P = Params([zeros(1),v,U,w,zeros(1),v2,ones(1)])
+                elif quadratic:
                     P = Params([zeros(1),v,J,zeros(1),v2,ones(1)])
                 else:
                     P = Params([zeros(1),v,zeros(1),v2,ones(1)])
 
                 # Set d to match mean firing rate on training set
-                R = array([resp(S[j,...],P) for j in pr])
+                R = evalResp(P,pr)
                 rmean = R.mean()
                 P[-1][:] = spikesmean/rmean
-                P = Params(P)
+                P = Params(P,dtype=dtype)
 
             # Calculate initial error
-            R = Resp(S,P,resp)
+            R = evalResp(P)
             errTrain = cost(YR,R[pr])/errTrain0
             errValid = cost(YV,R[pv])/errValid0
 
             # Save initial errors
-            with open(errTrainName,'w') as f:
+            with open(errTrainName,'wb') as f:
                 errTrain.tofile(f)
 
-            with open(errValidName,'w') as f:
+            with open(errValidName,'wb') as f:
                 errValid.tofile(f)
 
-            errValidHist = [errValid]
+            with open(errValidItsName,'wb') as f:
+                array(0,dtype=int64).tofile(f)
+
+            errValidHist = [(0,errValid)]
+            errTrainLog = [errTrain]
+            errValidLog = [errValid]
+            errValidItsLog = [0]
 
             # Save initial values as best so far
             errValidMin = errValid.copy()
             PV = P.copy()
 
             # Save initial parameters to parameter files
-            P.tofile(trainBestName)
-            PV.tofile(validBestName)
+            P.save(trainBestName,**header)
+            PV.save(validBestName,**header)
 
             # Keep track of the number of iterations
             its = 0
 
     stdout.write('Beginning optimization\n')
     stdout.flush()
-    if model in ['softplus','logistic']:
+    if lowRank:
+        Pname = ['a1','v1','U1','w1','a2','v2','d']
+    elif quadratic:
         Pname = ['a1','v1','J1','a2','v2','d']
     else:
         Pname = ['a1','v1','a2','v2','d']
@@ -413,99 +731,459 @@ def fitModel(prefix,spikes,stim,jack,fsize,extrapSteps=10,
     errTrainLast = errTrain.copy()
     PLast = P.copy()
 
+    # Errors accumulated during updates lag behind the parameters, so they
+    # are only compared with each other
+    if trainErrFromPass:
+        errTrainLast = array(inf)
+
     # Select and initialize learning rate rule
     if LRType == 'DecayRate':
-        LR = DecayRate(errTrain,its,**LRParams)
+        LR = DecayRate(errTrainLast,its,**LRParams)
     elif LRType == 'BoldDriver':
-        LR = BoldDriver(errTrain,**LRParams)
+        LR = BoldDriver(errTrainLast,**LRParams)
+    elif LRType == 'Momentum':
+        LR = Momentum(errTrainLast,**LRParams)
+    elif LRType == 'RMSProp':
+        LR = RMSProp(errTrainLast,**LRParams)
+    elif LRType == 'Adam':
+        LR = Adam(errTrainLast,**LRParams)
+    elif LRType == 'LBFGS':
+        LR = LBFGS(errTrainLast,**LRParams)
+    elif LRType == 'HessianFree':
+        LR = HessianFree(errTrainLast,**LRParams)
     else:
-        LR = LearningRate(errTrain,**LRParams)
-
-    # Run until slope of validation error becomes positive, time runs out,
-    # maximum iterations is reached, or learning rate falls to eps
-    while ((slope < 0) or (its<extrapSteps)) and (time() < eschaton) and (its < maxIts) and (LR.lrate > eps):
-
-        # For each training example, calculate gradient and update parameters
-        for j in pr:
-            y = Y[j]
-            s = S[j,...]
-            P +=  grad(y,s,P)*LR.lrate
-
-        # Increment to next iteration
-        its += 1
+        LR = LearningRate(errTrainLast,**LRParams)
+
+    # Gradients are written into G, which LR adds to P in place
+    G = P.copy()
+
+    # Copy training samples into contiguous chunks holding whole batches
+    loadSize = chunkLength(S,batchSize*-(-loadSize//batchSize),chunkElements,batchSize)
+    loader = BatchLoader(S,Y,pr,loadSize,
+                         RandomState() if shuffle else None,prefetch)
+
+    # Restore state of the learning rule and training order from checkpoint
+    if state is not None:
+        slope = state['slope']
+        errTrainLast = stateArrays['errTrainLast']
+        PLast = Params(stateArrays['PLast'],shapes,dtype)
+        LR.setState(state['LR'],{k[3:]:v for k,v in stateArrays.items()
+                                 if k.startswith('LR_')})
+        if loader.RS is not None and 'RS' in state:
+            name,pos,hasGauss,gauss = state['RS']
+            loader.RS.set_state((name,stateArrays['RS'],pos,hasGauss,gauss))
+
+    # Fixed subsample of training set and the cost of each of its samples for
+    # PLast, used to estimate changes of the training error
+    sampleErr = trainErrSample is not None and not (trainErrFromPass or LR.fullBatch)
+    if sampleErr:
+        if isinstance(trainErrSample,float) and trainErrSample <= 1:
+            trainErrSample = max(2,int(trainErrSample*pr.size))
+        else:
+            trainErrSample = IntCheck(trainErrSample)
+        ps = sort(RandomState(0).permutation(pr)[:trainErrSample])
+        YS = Y[ps]
+        costSample = costs(YS,evalResp(PLast,ps))
+
+    # Number of consecutive accepted iterations whose training error was
+    # estimated from the subsample
+    estimated = 0
+
+    # Training error of PLast on the full training set, replacing an estimate
+    def resyncTrain():
+        errTrain = cost(YR,evalResp(PLast,pr))/errTrain0
+        LR.lastError = errTrain
+        return errTrain
+
+    # Mean cost and gradient step direction of all training samples, summed
+    # from batch gradients written into G. The gradient of a packed J is the
+    # upper triangle of the full gradient, so its off-diagonal entries are
+    # doubled to give the derivative with respect to the packed values, as
+    # the line searches of full batch rules need.
+    GF = P.copy()
+    if packJ:
+        iJ,jJ = triuInd(npix)
+        offDiag = iJ != jJ
+    def fullGrad(P):
+        c = 0.
+        GF.buffer[:] = 0.
+        for YC,SC in loader:
+            c += bgrad(YC,SC,P,fused=True,out=G)[2]
+            GF.buffer += G.buffer
+        GF.buffer /= pr.size
+        if packJ:
+            GF[2][offDiag] *= 2
+        return c/pr.size,GF
+
+    # Output files are written by writer, from a background thread if
+    # writeBackground is True
+    writer = BackgroundWriter(writeBackground)
+
+    # Save parameters with the description of the model
+    def saveParams(P,name):
+        f = BytesIO()
+        P.save(f,**header)
+        writer.write(name,f.getvalue())
+
+    # Iteration and validation minimum, for fits without checkpoints
+    def saveStatus():
+        writer.write(statusName,array(its).tobytes()+array(errValidMin).tobytes())
+
+    # Full state of the fit. Arrays of the learning rule are prefixed by LR_.
+    def checkpoint():
+        values,arrays = LR.getState()
+        state = dict(its=its,slope=slope,LR=values)
+        stateArrays = {'LR_'+k:v for k,v in arrays.items()}
+        stateArrays.update(P=P.buffer,PV=PV.buffer,PLast=PLast.buffer,
+                           errTrainLast=array(errTrainLast),
+                           errValidMin=array(errValidMin),
+                           errTrainLog=array(errTrainLog),
+                           errValidLog=array(errValidLog),
+                           errValidItsLog=array(errValidItsLog,dtype=int64))
+        if loader.RS is not None:
+            name,key,pos,hasGauss,gauss = loader.RS.get_state()
+            state['RS'] = [name,pos,hasGauss,gauss]
+            stateArrays['RS'] = key
+        f = BytesIO()
+        saveCheckpoint(f,state,stateArrays)
+        writer.write(checkpointName,f.getvalue())
+
+    # Validation errors are calculated by validation, from a background
+    # thread if validBackground is True
+    validation = BackgroundEval(lambda PS: cost(YV,evalResp(PS,pv))/errValid0,
+                                validBackground)
+
+    # Adds validation error of parameters PS from iteration itsValid to
+    # history, refits the slope per iteration, and saves PS if the error is a
+    # new minimum.
+    # Returns slope and the parameters with the lowest validation error and
+    # that error.
+    def useValid(itsValid,PS,errValid):
+
+        errValidHist.append((itsValid,errValid))
+        del errValidHist[:-extrapSteps]
+
+        # Calculate slope of the validation error against the iterations it
+        # was calculated at, which are unevenly spaced if calculations were
+        # skipped
+        itsHist,errHist = array(errValidHist).T
+        x = ones((2,len(errValidHist)))
+        x[1,:] = itsHist-itsHist[-1]
+        slope = dot(inv(dot(x,x.T)),dot(x,errHist))[1]
+
+        # Append error and its iteration to history files
+        writer.append(errValidName,errValid.tobytes())
+        writer.append(errValidItsName,array(itsValid,dtype=int64).tobytes())
+        errValidLog.append(errValid)
+        errValidItsLog.append(itsValid)
+
+        # If validation error has reached new minimum, save parameters
+        if errValid < errValidMin:
+            errDown = errValidMin - errValid
+            saveParams(PS,validBestName)
+            print('%u: New validation minimum %.5g, down %.3g' %(itsValid,errValid,errDown))
+            print('Slope %.3e' % (slope,))
+            return slope,PS,errValid
 
-        # Calculate current training error and update learning rule
-        R = Resp(S,P,resp)
-        errTrain = cost(YR,R[pr])/errTrain0
-        LR.update(errTrain)
+        print('Slope %.3e' % (slope,))
+        return slope,PV,errValidMin
 
-        # If training error decreases
-        if errTrain < errTrainLast:
-            # Save new copies of last error and parameters
-            errTrainLast = errTrain.copy()
-            PLast = P.copy()
 
-            # Calculate validation error
-            errValid = cost(YV,R[pv])/errValid0
-            errValidHist.append(errValid)
+    epochs = 0
+    try:
+        if not checkpointEvery:
+            saveStatus()
+        elif state is None:
+            checkpoint()
 
-            # Calculate slope of the validation error
-            if len(errValidHist) > extrapSteps:
-                errValidHist = errValidHist[-extrapSteps:]
-            x = ones((2,len(errValidHist)))
-            x[1,:] = arange(len(errValidHist))
-            slope = dot(inv(dot(x,x.T)),dot(x,array(errValidHist)))[1]
+        # Run until slope of validation error becomes positive, time runs out,
+        # maximum iterations is reached, or learning rate falls to eps
+        while ((slope < 0) or (its<extrapSteps)) and (time() < eschaton) and (its < maxIts) and (LR.lrate > eps):
 
-            # Save current parameters
-            P.tofile(trainBestName)
+            # Full batch optimizers take one step per iteration using the
+            # cost and gradient of all training samples
+            errSum = 0.
+            if LR.fullBatch:
+                errSum = LR.stepFull(P,fullGrad)*pr.size
+            else:
+                for YC,SC in loader:
+
+                    # For each training example, calculate gradient and update parameters
+                    if batchSize == 1:
+                        if trainErrFromPass:
+                            for y,s in zip(YC,SC):
+                                r,c = grad(y,s,P,fused=True,out=G)[1:]
+                                errSum += c
+                                LR.step(P,G)
+                        else:
+                            for y,s in zip(YC,SC):
+                                LR.step(P,grad(y,s,P,out=G))
+
+                    # For each batch of training examples, update parameters using
+                    # gradient summed over the batch
+                    else:
+                        for j in range(0,len(YC),batchSize):
+                            r,c = bgrad(YC[j:j+batchSize],SC[j:j+batchSize],P,fused=True,out=G)[1:]
+                            errSum += c
+                            LR.step(P,G)
+
+            # Increment to next iteration
+            its += 1
+
+            # Calculate current training error and update learning rule
+            if trainErrFromPass or LR.fullBatch:
+                errTrain = array(errSum/pr.size)/errTrain0
+            elif sampleErr:
+                # Paired difference of the cost of each sample of the subsample
+                costNew = costs(YS,evalResp(P,ps))
+                diff = costNew-costSample
+                change = diff.mean(dtype=float64)
+                isEstimate = (estimated < trainErrResync and
+                              abs(change) > trainErrConfidence*diff.std(dtype=float64)/sqrt(diff.size))
+                if isEstimate:
+                    errTrain = errTrainLast+change/errTrain0
+                else:
+                    errTrain = cost(YR,evalResp(P,pr))/errTrain0
+            else:
+                errTrain = cost(YR,evalResp(P,pr))/errTrain0
+            LR.update(errTrain)
+
+            # If training error decreases
+            if errTrain < errTrainLast:
+                # Save new copies of last error and parameters
+                errTrainLast = errTrain.copy()
+                PLast = P.copy()
+                if sampleErr:
+                    costSample = costNew
+                    estimated = estimated+1 if isEstimate else 0
+
+                # Save current parameters
+                saveParams(P,trainBestName)
+
+                # Append training error to history file
+                writer.append(errTrainName,errTrain.tobytes())
+                errTrainLog.append(errTrain)
+
+                # Request validation error of the parameters
+                if its % validEvery == 0:
+                    validation.submit(its,PLast)
+
+                # Print status
+                print('%u Values:' % (its,), end=' ')
+                for nam,p in zip(Pname,P):
+                    if p.size == 1:
+                        print(' %s %.3e' % (nam,p), end=' ')
+                    else:
+                        print(' %s %.3e' % (nam,norm(p)), end=' ')
+                print('')
+            else:
+                print('Training error increased: learning rate too high')
+                print('New learning rate %.3e' % LR.lrate)
+                its -= 1
+                P = PLast.copy()
+
+            # Use validation errors that have been calculated
+            for itsValid,PS,errValid in validation.results():
+                slope,PV,errValidMin = useValid(itsValid,PS,errValid)
+
+            epochs += 1
+            if not checkpointEvery:
+                saveStatus()
+            elif epochs % checkpointEvery == 0:
+                if estimated:
+                    errTrainLast,estimated = resyncTrain(),0
+                checkpoint()
+
+        # Wait for remaining validation errors
+        for itsValid,PS,errValid in validation.results(wait=True):
+            slope,PV,errValidMin = useValid(itsValid,PS,errValid)
+
+        # If not converged, save the latest state to resume from
+        converged = time() < eschaton and its < maxIts
+        if not converged and not checkpointEvery:
+            saveStatus()
+        elif not converged and epochs % checkpointEvery:
+            if estimated:
+                errTrainLast,estimated = resyncTrain(),0
+            checkpoint()
+
+    finally:
+        # Finish writing output files, even if validation failed
+        try:
+            validation.close()
+        finally:
+            writer.close()
+
+    # If converged, delete checkpoint and status files
+    if converged:
+        for name in [checkpointName,statusName]:
+            if exists(name):
+                remove(name)
 
-            # Append errors to history files
-            with open(errTrainName,'a') as f:
-                errTrain.tofile(f)
+    # Note that program has terminated successfully
+    stdout.write('Time elapsed {0:.3f} hours\n'.format((time()-genesis)/3600.))
+    stdout.write('Finished\n')
+    stdout.flush()
 
-            with open(errValidName,'a') as f:
-                errValid.tofile(f)
+# Saves state of fitModel to f as a numpy .npz file of the arrays in
+# stateArrays, with the values in state, which must be serializable as JSON
+# (numpy scalars are stored as numbers), as a JSON header in its entry header
+def saveCheckpoint(f,state,stateArrays):
+
+    header = json.dumps(state,default=lambda x: x.tolist()).encode('utf-8')
+    savez(f,header=frombuffer(header,dtype=uint8),**stateArrays)
+
+# Reads state saved by checkpoints of fitModel, without unpickling anything.
+# Returns the dictionary of values from the header and the dictionary of
+# arrays.
+def loadCheckpoint(name):
+
+    with loadNumpy(name) as f:
+        stateArrays = {k:f[k] for k in f.files}
+    state = json.loads(stateArrays.pop('header').tobytes().decode('utf-8'))
+
+    return state,stateArrays
+
+# Stimulus shared by worker processes of fitJackknife
+sharedStim = None
+sharedMem = None
+
+# Attach worker process to the shared stimulus as a read-only array
+def attachStim(name,shape,dtype):
+
+    global sharedStim, sharedMem
+    sharedMem = SharedMemory(name)
+    sharedStim = ndarray_(shape,dtype=dtype,buffer=sharedMem.buf)
+    sharedStim.flags.writeable = False
+
+# Fit one jackknife of one model using the shared stimulus
+def fitShared(args):
+
+    prefix,spikes,jack,fsize,model,kwargs = args
+    kwargs = dict(kwargs)
+    stim = kwargs.pop('stim',sharedStim)
+    pixelNorm = kwargs.pop('pixelNorm',None)
+    fitModel(prefix,spikes,stim,jack,fsize,model=model,pixelNorm=pixelNorm,**kwargs)
+
+    return model,jack
+
+# Normalize stimulus into shared memory and run fitShared on each task in a
+# pool of processes that map the stimulus read-only
+def mapShared(stim,pixelNorm,dtype,tasks,processes=None):
+
+    if processes is None:
+        processes = min(cpu_count(),len(tasks))
+
+    # Normalize stimulus once into the cache and let workers memmap it
+    cacheDir = tasks[0][-1].get('cacheDir')
+    if cacheDir is not None and pixelNorm is not None:
+        cache = StimCache(cacheDir,tasks[0][-1].get('cacheBytes'),
+                          tasks[0][-1].get('chunkSize',1024))
+        stim,stimAve,stimStDev = cache.normalize(stim,pixelNorm,dtype)
+        tasks = [t[:-1]+(dict(t[-1],stimNorm=(stimAve,stimStDev)),) for t in tasks]
+        stim = stim.filename
+        pixelNorm = None
+
+    # Memmapped stimuli are mapped again from their file by each worker and
+    # normalized as samples are read, so they are never copied into memory.
+    # Statistics are calculated once here.
+    if isinstance(stim,memmap) and isinstance(stim.base,mmap):
+        stim.flush()
+        if pixelNorm is not None and not isinstance(pixelNorm,tuple):
+            pixelNorm = stimStats(stim,pixelNorm)
+        order = 'F' if stim.flags.f_contiguous and not stim.flags.c_contiguous else 'C'
+        stim = dict(filename=stim.filename,offset=stim.offset,shape=stim.shape,
+                    dtype=stim.dtype,order=order)
+
+    # Stimulus files are memmapped by each worker and shared through the page
+    # cache instead
+    if isinstance(stim,(str,list,tuple,dict)):
+        tasks = [t[:-1]+(dict(t[-1],stim=stim,pixelNorm=pixelNorm),) for t in tasks]
+        pool = Pool(processes)
+        try:
+            done = pool.map(fitShared,tasks,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return done
+
+    # Copy stimulus into shared memory and normalize it there
+    dtype = dtype_(dtype)
+    mem = SharedMemory(create=True,size=max(1,stim.size*dtype.itemsize))
+    try:
+        shared = ndarray_(stim.shape,dtype=dtype,buffer=mem.buf)
+        shared[...] = stim
+        if pixelNorm is not None:
+            stimAve,stimStDev = normStim(shared,pixelNorm)[1:]
+            tasks = [t[:-1]+(dict(t[-1],stimNorm=(stimAve,stimStDev)),) for t in tasks]
+        del shared
+
+        pool = Pool(processes,attachStim,(mem.name,stim.shape,dtype))
+        try:
+            done = pool.map(fitShared,tasks,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        mem.close()
+        mem.unlink()
+
+    return done
 
-            # If validation error has reached new minimum
-            if errValid < errValidMin:
+"""
+Fits every jackknife (and optionally several models) concurrently in a pool
+of processes. The stimulus is normalized once, placed in shared memory, and
+mapped read-only into each worker, which runs fitModel on it. Stimulus files
+and memmaps are instead memmapped by each worker and normalized as they are
+read.
+Inputs:
+    prefix, spikes, stim, fsize: As in fitModel. stim is not modified.
+    Njack: Number of jackknives. Jackknives 1 to Njack are fit.
+    models: Model type or list of model types to fit.
+    processes: Number of worker processes. Defaults to the number of CPUs or
+        the number of fits, whichever is smaller.
+    pixelNorm: Normalization used, as in fitModel.
+    kwargs: Other options passed to fitModel.
+Returns list of (model,jack) fits that finished.
+"""
+def fitJackknife(prefix,spikes,stim,fsize,Njack=4,models='softplus',
+                 processes=None,pixelNorm=True,**kwargs):
 
-                # Update best value
-                errValidMin = errValid
+    if isinstance(models,str):
+        models = [models]
+    Njack = IntCheck(Njack)
+    tasks = [(prefix,spikes,jack,fsize,model,dict(kwargs,Njack=Njack))
+             for model in models for jack in range(1,Njack+1)]
 
-                # Copy parameters and save to parameter file
-                PV = P.copy()
-                PV.tofile(validBestName)
+    return mapShared(stim,pixelNorm,kwargs.get('dtype',float),tasks,processes)
 
-                # Output note of improvement
-                errDown = errValidMin - errValid
-                print('%u: New validation minimum %.5g, down %.3g' %(its,errValidMin,errDown))
+"""
+Fits models of many neurons recorded with the same stimulus. The stimulus is
+normalized once into shared memory and the training and validation sets are
+computed once, then each neuron is fit by fitModel in a pool of processes.
+Output files of neuron n use the prefix prefix+'_cell%u' % n.
+Inputs:
+    prefix, stim, jack, fsize: As in fitModel. stim is not modified.
+    spikes: numpy array of responses with shape (neurons, samples)
+    processes: Number of worker processes. Defaults to the number of CPUs or
+        the number of neurons, whichever is smaller.
+    pixelNorm, Njack, nlags, perm, splits: As in fitModel.
+    kwargs: Other options passed to fitModel.
+Returns list of (model,neuron) fits that finished.
+"""
+def fitNeurons(prefix,spikes,stim,jack,fsize,processes=None,pixelNorm=True,
+               Njack=4,nlags=1,perm=True,splits=None,**kwargs):
 
-            # Save current status
-            with open(statusName,'w') as f:
-                array(its).tofile(f)
-                errValidMin.tofile(f)
+    assert spikes.ndim == 2
 
-            # Print status
-            print('%u Values:' % (its,), end=' ')
-            for nam,p in zip(Pname,P):
-                if p.size == 1:
-                    print(' %s %.3e' % (nam,p), end=' ')
-                else:
-                    print(' %s %.3e' % (nam,norm(p)), end=' ')
-            print('')
-            print('Slope %.3e' % (slope,))
-        else:
-            print('Training error increased: learning rate too high')
-            print('New learning rate %.3e' % LR.lrate)
-            its -= 1
-            P = PLast.copy()
+    # Training and validation sets shared by all neurons
+    sets = splitSets(spikes.shape[1]-nlags+1,IntCheck(jack),IntCheck(Njack),nlags,perm,splits)
 
-    # If converged, delete status file
-    if time() < eschaton and its < maxIts:
-        remove(statusName)
+    model = kwargs.pop('model','softplus')
+    kwargs.update(Njack=Njack,nlags=nlags,sets=sets)
+    tasks = [(prefix+'_cell%u' % (n,),spikes[n],jack,fsize,model,kwargs)
+             for n in range(spikes.shape[0])]
 
-    # Note that program has terminated successfully
-    stdout.write('Time elapsed {0:.3f} hours\n'.format((time()-genesis)/3600.))
-    stdout.write('Finished\n')
-    stdout.flush()
+    mapShared(stim,pixelNorm,kwargs.get('dtype',float),tasks,processes)
 
+    return [(model,n) for n in range(spikes.shape[0])]
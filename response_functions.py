@@ -1,6 +1,8 @@
 from gradients import *
 
 from numpy import tensordot as tdot
+from numpy import arange, concatenate, dot, matmul
+from utils import flatStim, chunkLength
 
 """Responses for different types of models"""
 
@@ -20,6 +22,10 @@ def respSP(S,P):
 
     ndim = v1.ndim
 
+    # Unpack quadratic filter stored as upper triangle
+    if J.ndim == 1:
+        J = unpackSym(J).reshape(2*v1.shape)
+
     # Calculate first layer responses
     r1 = f1(a1+tdot(v1,S,2*(list(range(ndim)),))+(tdot(J,S,2*(list(range(ndim)),))*S).sum(tuple(range(ndim))))
 
@@ -68,6 +74,10 @@ def respLog2(S,P):
 
     ndim = v1.ndim
 
+    # Unpack quadratic filter stored as upper triangle
+    if J.ndim == 1:
+        J = unpackSym(J).reshape(2*v1.shape)
+
     # Calculate first layer responses
     r1 = f1(a1+tdot(v1,S,2*(list(range(ndim)),))+(tdot(J,S,2*(list(range(ndim)),))*S).sum(tuple(range(ndim))))
 
@@ -100,8 +110,236 @@ def respLinearLog2(S,P):
 
     return d*r2
 
+# Calculates responses for softplus model for a batch of stimuli
+def respSPBatch(S,P):
+    # Inputs:
+    #   S - Stimuli with sample number as first dimension
+    #   P - Model parameters
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    # Extract parameters
+    a1,v1,J,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    # Unpack quadratic filter stored as upper triangle
+    if J.ndim == 1:
+        J = unpackSym(J)
+    else:
+        J = J.reshape(2*(v1.size,))
+
+    # Calculate first layer responses
+    r1 = f1(a1+matmul(v1.ravel(),S)+(matmul(J,S)*S).sum(1))
+
+    # Calculate second layer responses
+    r2 = f2(a2+matmul(r1,v2.ravel()))
+
+    return d*r2
+
+# Calculates responses for linear softplus model for a batch of stimuli
+def respLinearSPBatch(S,P):
+    # Inputs:
+    #   S - Stimuli with sample number as first dimension
+    #   P - Model parameters
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    # Extract parameters
+    a1,v1,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    # Calculate first layer responses
+    r1 = f1(a1+matmul(v1.ravel(),S))
+
+    # Calculate second layer responses
+    r2 = f2(a2+matmul(r1,v2.ravel()))
+
+    return d*r2
+
+# Calculates responses for logistic model for a batch of stimuli
+def respLog2Batch(S,P):
+    # Inputs:
+    #   S - Stimuli with sample number as first dimension
+    #   P - Model parameters
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    # Extract parameters
+    a1,v1,J,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    # Unpack quadratic filter stored as upper triangle
+    if J.ndim == 1:
+        J = unpackSym(J)
+    else:
+        J = J.reshape(2*(v1.size,))
+
+    # Calculate first layer responses
+    r1 = f1(a1+matmul(v1.ravel(),S)+(matmul(J,S)*S).sum(1))
+
+    # Calculate second layer responses
+    r2 = f2(a2+matmul(r1,v2.ravel()))
+
+    return d*r2
+
+# Calculates responses for linear logistic model for a batch of stimuli
+def respLinearLog2Batch(S,P):
+    # Inputs:
+    #   S - Stimuli with sample number as first dimension
+    #   P - Model parameters
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    # Extract parameters
+    a1,v1,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    # Calculate first layer responses
+    r1 = f1(a1+matmul(v1.ravel(),S))
+
+    # Calculate second layer responses
+    r2 = f2(a2+matmul(r1,v2.ravel()))
+
+    return d*r2
+
+# Calculates responses for low-rank softplus model
+def respLowRankSP(S,P):
+    # Inputs:
+    #   S - A stimulus
+    #   P - Model parameters
+    # Output:
+    #   r - Response of model for given stimulus
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    Sf = S.reshape(v1.size,-1)
+
+    # Calculate first layer responses
+    r1 = f1(a1+dot(v1.ravel(),Sf)+dot(w,dot(U.reshape(w.size,-1),Sf)**2))
+
+    # Calculate second layer responses
+    r2 = f2(a2+(r1*v2.ravel()).sum())
+
+    return d*r2
+
+# Calculates responses for low-rank logistic model
+def respLowRankLog2(S,P):
+    # Inputs:
+    #   S - A stimulus
+    #   P - Model parameters
+    # Output:
+    #   r - Response of model for given stimulus
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    Sf = S.reshape(v1.size,-1)
+
+    # Calculate first layer responses
+    r1 = f1(a1+dot(v1.ravel(),Sf)+dot(w,dot(U.reshape(w.size,-1),Sf)**2))
+
+    # Calculate second layer responses
+    r2 = f2(a2+(r1*v2.ravel()).sum())
+
+    return d*r2
+
+# Calculates responses for low-rank softplus model for a batch of stimuli
+def respLowRankSPBatch(S,P):
+    # Inputs:
+    #   S - Stimuli with sample number as first dimension
+    #   P - Model parameters
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,softPlus
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    # Calculate first layer responses
+    r1 = f1(a1+matmul(v1.ravel(),S)+matmul(w,matmul(U.reshape(w.size,-1),S)**2))
+
+    # Calculate second layer responses
+    r2 = f2(a2+matmul(r1,v2.ravel()))
+
+    return d*r2
+
+# Calculates responses for low-rank logistic model for a batch of stimuli
+def respLowRankLog2Batch(S,P):
+    # Inputs:
+    #   S - Stimuli with sample number as first dimension
+    #   P - Model parameters
+    # Output:
+    #   r - Responses of model for each stimulus
+
+    # Extract parameters
+    a1,v1,U,w,a2,v2,d = P
+
+    # Model nonlinearities
+    f1,f2 = logistic,logistic
+
+    ndim = v1.ndim
+    S = flatStim(S,ndim)
+
+    # Calculate first layer responses
+    r1 = f1(a1+matmul(v1.ravel(),S)+matmul(w,matmul(U.reshape(w.size,-1),S)**2))
+
+    # Calculate second layer responses
+    r2 = f2(a2+matmul(r1,v2.ravel()))
+
+    return d*r2
+
 # Calculate responses of many stimuli
 def Resp(S,P,func):
     r = array([func(s,P) for s in S])
     rs = r.shape[:1]+r.shape[2:]
-    return r.reshape(rs)
\ No newline at end of file
+    return r.reshape(rs)
+
+# Calculate responses of many stimuli using a batch response function
+def BatchResp(S,P,func,ind=None,chunkSize=1024,maxSize=2**22):
+    # Inputs:
+    #   S - Stimuli with sample number as first dimension
+    #   P - Model parameters
+    #   func - Batch response function (e.g. respSPBatch)
+    #   ind - Indices of samples to evaluate. All samples if None.
+    #   chunkSize - Maximum number of samples evaluated per call to func
+    #   maxSize - Maximum number of stimulus elements per call to func
+    # Output:
+    #   r - Response of model for each sample
+
+    if ind is None:
+        ind = arange(S.shape[0])
+    chunkSize = chunkLength(S,chunkSize,maxSize)
+
+    return concatenate([func(S[ind[j:j+chunkSize],...],P) for j in range(0,len(ind),chunkSize)])
@@ -0,0 +1,6 @@
+# The modules are not installed as a package, so tests import them from the
+# repository root
+import sys
+from os.path import abspath, dirname
+
+sys.path.insert(0,dirname(dirname(abspath(__file__))))
@@ -0,0 +1,53 @@
+from numpy import array_equal, memmap
+from numpy.random import RandomState
+
+from Params import Params, loadParams
+
+def params(dtype=float):
+
+    RS = RandomState(0)
+    return Params([RS.randn(1),RS.randn(3,2),RS.randn(4,3,2)],dtype=dtype)
+
+def test_save_load(tmp_path):
+
+    P = params()
+    name = str(tmp_path/'P.dat')
+    P.save(name,model='softplus',fsize=(3,2),nlags=2)
+
+    # Memory mapped by default
+    Q,header = loadParams(name)
+    assert isinstance(Q.buffer.base,memmap)
+    assert array_equal(Q.buffer,P.buffer)
+    assert Q.shapes == P.shapes
+    assert all([q.shape == p.shape for q,p in zip(Q,P)])
+    assert header['model'] == 'softplus'
+    assert header['fsize'] == [3,2]
+    assert header['nlags'] == 2
+
+    # Read into memory, and by the constructor
+    Q,header = loadParams(name,mmap_mode=None)
+    assert Q.buffer.flags.owndata
+    assert array_equal(Q.buffer,P.buffer)
+    assert array_equal(Params(name).buffer,P.buffer)
+
+def test_save_load_dtype(tmp_path):
+
+    P = params('float32')
+    name = str(tmp_path/'P.dat')
+    P.save(name)
+
+    Q = loadParams(name)[0]
+    assert Q.buffer.dtype == P.buffer.dtype
+    assert array_equal(Q.buffer,P.buffer)
+    assert loadParams(name,dtype=float)[0].buffer.dtype == float
+
+# Files of raw values are read with the shapes given
+def test_load_raw(tmp_path):
+
+    P = params()
+    name = str(tmp_path/'P.dat')
+    P.tofile(name)
+
+    Q,header = loadParams(name,P.shapes)
+    assert header == {}
+    assert array_equal(Q.buffer,P.buffer)
@@ -0,0 +1,53 @@
+from file_tools import BackgroundWriter
+
+def read(name):
+
+    with open(name,'rb') as f:
+        return f.read()
+
+# Holding cond keeps the background thread from taking writes, so they are
+# all queued when the next one arrives
+
+def test_write_coalesces(tmp_path):
+
+    name = str(tmp_path/'f')
+    writer = BackgroundWriter()
+    with writer.cond:
+        for data in [b'a',b'b',b'c']:
+            writer.write(name,data)
+        assert writer.count == 1
+    writer.close()
+
+    assert read(name) == b'c'
+
+def test_append_in_order(tmp_path):
+
+    name = str(tmp_path/'f')
+    writer = BackgroundWriter()
+    with writer.cond:
+        writer.write(name,b'a')
+        writer.append(name,b'b')
+        writer.append(name,b'c')
+        assert writer.count == 3
+    writer.flush()
+    assert read(name) == b'abc'
+
+    # A write replacing the file discards appends that have not started
+    with writer.cond:
+        writer.append(name,b'd')
+        writer.write(name,b'e')
+        writer.append(name,b'f')
+        assert writer.count == 2
+    writer.close()
+
+    assert read(name) == b'ef'
+
+def test_write_immediate(tmp_path):
+
+    name = str(tmp_path/'f')
+    writer = BackgroundWriter(False)
+    writer.write(name,b'a')
+    writer.append(name,b'b')
+
+    assert read(name) == b'ab'
+    writer.close()
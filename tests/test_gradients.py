@@ -0,0 +1,93 @@
+from numpy import zeros, ones
+from numpy.random import RandomState
+import pytest
+
+from response_functions import *
+from math_utils import llikes, packSym, triuInd
+from Params import Params
+
+fsize,gsize,N,rank = (3,2,2),(2,3,1),5,2
+npix = 12
+
+# Check gradient function grad against central finite differences of the
+# summed cost of response function resp. grad and resp are both per-sample or
+# both batch functions, matching Y and S. Returns the largest error relative
+# to the largest finite difference derivative.
+def checkGrad(grad,resp,Y,S,P,step=1e-6):
+
+    G = grad(Y,S,P)
+
+    D = zeros(P.buffer.size)
+    Q = P.copy()
+    for j in range(D.size):
+        Q.buffer[j] = P.buffer[j]+step
+        cp = llikes(Y,resp(S,Q)).sum()
+        Q.buffer[j] = P.buffer[j]-step
+        cm = llikes(Y,resp(S,Q)).sum()
+        Q.buffer[j] = P.buffer[j]
+        D[j] = (cm-cp)/(2*step)
+
+    return abs(G.buffer-D).max()/abs(D).max()
+
+# Random stimuli, responses, and starting parameters
+def data(quadratic,lowRank=False,packed=False):
+
+    RS = RandomState(0)
+    S = RS.randn(N,*(fsize+gsize))
+    Y = RS.poisson(2.,N).astype(float)
+
+    P = [RS.randn(1),RS.randn(*fsize)*.3]
+    if lowRank:
+        P += [RS.randn(rank,*fsize)*.3,RS.randn(rank)]
+    elif quadratic:
+        J = RS.randn(*2*fsize)*.1
+        J = J+J.transpose(3,4,5,0,1,2)
+        if packed:
+            J = packSym(J.reshape(npix,npix))
+        P += [J]
+    P = Params(P+[RS.randn(1),RS.randn(*gsize)*.3,ones(1)*2.])
+
+    return Y,S,P
+
+models = [('softplus',gradSP,respSP,gradSPBatch,respSPBatch,True,False),
+          ('linearSoftplus',gradLinearSP,respLinearSP,gradLinearSPBatch,respLinearSPBatch,False,False),
+          ('logistic',gradLog2,respLog2,gradLog2Batch,respLog2Batch,True,False),
+          ('linearLogistic',gradLinearLog2,respLinearLog2,gradLinearLog2Batch,respLinearLog2Batch,False,False),
+          ('lowRankSoftplus',gradLowRankSP,respLowRankSP,gradLowRankSPBatch,respLowRankSPBatch,True,True),
+          ('lowRankLogistic',gradLowRankLog2,respLowRankLog2,gradLowRankLog2Batch,respLowRankLog2Batch,True,True)]
+
+@pytest.mark.parametrize('model,grad,resp,bgrad,bresp,quadratic,lowRank',models,
+                         ids=[m[0] for m in models])
+def test_gradient(model,grad,resp,bgrad,bresp,quadratic,lowRank):
+
+    Y,S,P = data(quadratic,lowRank)
+
+    assert checkGrad(grad,resp,Y[0],S[0],P) < 1e-6
+    assert checkGrad(bgrad,bresp,Y,S,P) < 1e-6
+
+# The gradient of a packed J is the upper triangle of the full gradient, so
+# its off-diagonal entries are half the derivative with respect to the packed
+# values
+packedModels = [('softplus',gradSP,respSP,gradSPBatch,respSPBatch),
+                ('logistic',gradLog2,respLog2,gradLog2Batch,respLog2Batch)]
+
+@pytest.mark.parametrize('model,grad,resp,bgrad,bresp',packedModels,
+                         ids=[m[0] for m in packedModels])
+def test_gradient_packed(model,grad,resp,bgrad,bresp):
+
+    Y,S,P = data(True,packed=True)
+    iJ,jJ = triuInd(npix)
+
+    def packedGrad(grad):
+        def G(Y,S,P):
+            G = grad(Y,S,P)
+            G[2][iJ != jJ] *= 2
+            return G
+        return G
+
+    assert checkGrad(packedGrad(grad),resp,Y[0],S[0],P) < 1e-6
+    assert checkGrad(packedGrad(bgrad),bresp,Y,S,P) < 1e-6
+
+    # Packed and full J give the same responses
+    Yf,Sf,PF = data(True)
+    assert abs(bresp(S,P)-bresp(Sf,PF)).max() < 1e-12
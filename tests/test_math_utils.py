@@ -0,0 +1,29 @@
+from numpy import empty, array_equal
+from numpy.random import RandomState
+
+from math_utils import packSym, unpackSym, triuInd
+
+def test_pack_unpack():
+
+    n = 7
+    J = RandomState(0).randn(n,n)
+    J = J+J.T
+
+    Jp = packSym(J)
+    assert Jp.shape == (n*(n+1)//2,)
+    i,j = triuInd(n)
+    assert array_equal(Jp,J[i,j])
+    assert array_equal(unpackSym(Jp),J)
+
+    # Packing into a given array
+    out = empty(Jp.size)
+    assert packSym(J,out) is out
+    assert array_equal(out,Jp)
+
+def test_pack_dtype():
+
+    J = RandomState(1).randn(4,4).astype('float32')
+    J = J+J.T
+
+    assert packSym(J).dtype == J.dtype
+    assert unpackSym(packSym(J)).dtype == J.dtype
@@ -0,0 +1,23 @@
+from numpy import allclose
+from numpy.random import RandomState
+import pytest
+
+from utils import stimStats, normStim
+
+# Merged chunk statistics match those of the whole stimulus, including when
+# the last chunk is shorter and chunks have one frame
+@pytest.mark.parametrize('pixelNorm',[True,False])
+@pytest.mark.parametrize('chunkSize',[1,37,1024])
+def test_stimStats(pixelNorm,chunkSize):
+
+    stim = RandomState(0).randn(4,3,200)*2+5
+    stim[1,2,:] = 3.
+
+    stimAve,stimStDev = stimStats(stim,pixelNorm,chunkSize)
+    aveNorm,stDevNorm = normStim(stim.copy(),pixelNorm)[1:]
+
+    assert stimAve.shape == aveNorm.shape
+    assert allclose(stimAve,aveNorm,rtol=1e-12,atol=1e-12)
+    assert allclose(stimStDev,stDevNorm,rtol=1e-12,atol=1e-12)
+    if pixelNorm:
+        assert stimStDev[1,2,0] == 0.
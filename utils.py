@@ -3,24 +3,31 @@ Utilities for stimulus processing
 
 """
 from numpy.lib.stride_tricks import as_strided
-from warnings import filterwarnings
-import warnings
 
-from numpy import isfinite, array, ndarray
+from numpy import isfinite, array, ndarray, prod, float64, ascontiguousarray
+from numpy import asarray, broadcast_to, errstate, load, sqrt, where, savez
+from numpy import dtype as dtype_, memmap
+from numpy.lib.format import open_memmap
+from os import remove, replace, listdir, makedirs, getpid, stat, utime
+from os.path import exists, isdir, join, getsize, getmtime, expanduser, abspath
+from tempfile import NamedTemporaryFile
+from hashlib import blake2b
+from queue import Queue, Empty
+from threading import Thread, Condition, Event
 
 
 def normStim(stim,pixelNorm=True):
     """
     Normalize stimulus
-        stim: numpy array with sample number as last dimension
+        stim: numpy array with sample number as last dimension. Statistics
+           are calculated in float64 in one pass (see stimStats) and stim
+           keeps its dtype. stim is normalized in place; for a memmapped
+           stimulus, use stimStats and NormView to normalize lazily instead.
         pixelNorm: If True, normalize each location by individual mean and stdev.
            If a tuple, use first element as mean and second as stdev.
            Otherwise, normalize using global statistics.
         Returns normalized stimulus, mean, and stdev.
     """
-    # Ignore divide by zero warnings
-    filterwarnings('ignore','invalid value encountered in divide')
-
     # Normalize using given values
     if isinstance(pixelNorm,tuple):
         # Should contain two values: mean, stdev
@@ -34,28 +41,18 @@ def normStim(stim,pixelNorm=True):
         elif isinstance(stimAve,ndarray):
             assert stimAve.shape == stim.shape[:-1]+(1,) or stimAve.size == 1
 
-    # Normalize using pixel statistics
-    elif pixelNorm:
-        stimAve = stim.mean(axis=-1)
-        stimAve.shape += (1,)
-        stimStDev = stim.std(axis=-1)
-        stimStDev.shape += (1,)
-
-    # Normalize using full stimulus statistics
+    # Normalize using pixel or full stimulus statistics
     else:
-        stimAve = stim.mean()
-        stimStDev = stim.std()
+        stimAve,stimStDev = stimStats(stim,pixelNorm)
 
-    # Normalize stim
-    stim -= stimAve
-    stim /= stimStDev
+    # Normalize stim, ignoring divide by zero warnings
+    with errstate(divide='ignore',invalid='ignore'):
+        stim -= stimAve
+        stim /= stimStDev
 
     # Check for bad pixels (usually pixel with no variation)
     stim[~isfinite(stim)]=0.
 
-    # Remove filter added above so it does not affect later code
-    warnings.filters = warnings.filters[1:]
-
     return stim,stimAve,stimStDev
 
 # Check if x is an integer
@@ -78,4 +75,527 @@ def gridStim(stim,fsize,nlags=1):
     Ssh = (ssh[-1]-nlags+1,)+fsize+gsize
     Sst = sst[-1:]+2*sst
 
-    return as_strided(stim,shape=Ssh,strides=Sst)
\ No newline at end of file
+    return as_strided(stim,shape=Ssh,strides=Sst)
+
+# Flatten a batch of patches to (samples, pixels, grid locations)
+def flatStim(S,ndim):
+
+    ssh = S.shape
+
+    return S.reshape(ssh[:1]+(prod(ssh[1:ndim+1]),prod(ssh[ndim+1:])))
+
+# Number of samples of S to process at once: at most n, and few enough that a
+# chunk has at most maxSize elements, rounded down to a multiple of step but
+# never less than step
+def chunkLength(S,n,maxSize=2**22,step=1):
+
+    m = min(n,maxSize//int(prod(S.shape[1:])))
+
+    return max(step,m-m%step)
+
+# Create collection of stimulus windows of nlags frames
+def frameStim(stim,nlags=1):
+
+    ssh = stim.shape
+    sst = stim.strides
+
+    Ssh = (ssh[-1]-nlags+1,)+ssh[:-1]+(nlags,)
+    Sst = sst[-1:]+sst
+
+    return as_strided(stim,shape=Ssh,strides=Sst)
+
+class BatchLoader(object):
+    """
+    BatchLoader iterates over samples of a gridded stimulus in chunks that are
+    copied into contiguous arrays, so that the training loop does not read
+    overlapping, scattered memory from the strided view made by gridStim.
+    Constructor inputs:
+        S: Stimulus with sample number as first dimension (e.g. from gridStim)
+        Y: Responses for each sample
+        ind: Indices of samples to iterate over
+        loadSize: Number of samples copied at once
+        RS: If a RandomState, ind is shuffled with it at the start of every
+            pass. Otherwise samples are visited in the order given by ind.
+        background: If True, the next chunk is copied in a background thread
+            while the current one is being used.
+    Iterating gives (responses, stimuli) for each chunk.
+    """
+    def __init__(self,S,Y,ind,loadSize=256,RS=None,background=False):
+
+        self.S = S
+        self.Y = Y
+        self.ind = ind
+        self.loadSize = loadSize
+        self.RS = RS
+        self.background = background
+
+    # Indices of the chunks of the next pass
+    def chunks(self):
+
+        if self.RS is None:
+            ind = self.ind
+        else:
+            ind = self.ind[self.RS.permutation(len(self.ind))]
+
+        return [ind[j:j+self.loadSize] for j in range(0,len(ind),self.loadSize)]
+
+    # Copy samples into contiguous arrays
+    def load(self,ind):
+
+        return self.Y[ind],ascontiguousarray(self.S[ind,...])
+
+    def __iter__(self):
+
+        chunks = self.chunks()
+
+        if not self.background:
+            for ind in chunks:
+                yield self.load(ind)
+            return
+
+        # Fill a queue of two chunks from a background thread. An error while
+        # loading is passed through the queue and raised here, and stop ends
+        # the thread if iteration ends early.
+        queue = Queue(2)
+        stop = Event()
+        def fill():
+            try:
+                for ind in chunks:
+                    if stop.is_set():
+                        return
+                    queue.put(self.load(ind))
+                queue.put(None)
+            except Exception as e:
+                queue.put(e)
+        thread = Thread(target=fill)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                chunk = queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk,Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            # Empty the queue until the thread ends, so that it is not left
+            # waiting to add a chunk
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            thread.join()
+
+class BackgroundWorker(object):
+    """
+    BackgroundWorker runs queued tasks one at a time from a background thread
+    so that the caller does not wait for them. Errors of the background
+    thread are raised by the next call to check. Subclasses keep the queue
+    and define the methods
+        waiting(): Whether tasks are queued
+        take(): Remove the next task from the queue and return it
+        work(task): Run task
+        finish(task): Called after task has run, whether or not it raised an
+            error. Does nothing unless overridden.
+    All but work are called with cond held.
+    Constructor inputs:
+        background: If False, no thread is started and subclasses run tasks
+            immediately.
+    """
+    def __init__(self,background=True):
+
+        self.background = background
+        self.active = False
+        self.closed = False
+        self.error = None
+        self.cond = Condition()
+
+        if background:
+            self.thread = Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Called after task has run (see class description)
+    def finish(self,task):
+
+        pass
+
+    # Raise error of background thread
+    def check(self):
+
+        if self.error is not None:
+            error,self.error = self.error,None
+            raise error
+
+    # Run queued tasks until closed and the queue is empty
+    def run(self):
+
+        while True:
+            with self.cond:
+                while not self.waiting() and not self.closed:
+                    self.cond.wait()
+                if not self.waiting():
+                    return
+                task = self.take()
+                self.active = True
+
+            try:
+                self.work(task)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+
+            with self.cond:
+                self.finish(task)
+                self.active = False
+                self.cond.notify_all()
+
+    # Wait until all queued tasks are done
+    def flush(self):
+
+        if self.background:
+            with self.cond:
+                while self.waiting() or self.active:
+                    self.cond.wait()
+                self.check()
+
+    # Finish queued tasks and stop the background thread
+    def close(self):
+
+        if self.background and not self.closed:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+            self.thread.join()
+            self.check()
+
+class BackgroundEval(BackgroundWorker):
+    """
+    BackgroundEval calculates func(arg) for arguments submitted during
+    training, optionally from a background thread (see BackgroundWorker).
+    At most one calculation runs at a time, and an argument submitted while
+    one is running replaces any argument that has not started yet, so
+    results may skip keys when they take longer than training steps.
+    Constructor inputs:
+        func: Function of one argument to evaluate
+        background: If False, func is evaluated immediately by submit.
+    """
+    def __init__(self,func,background=False):
+
+        self.func = func
+        self.pending = None
+        self.done = []
+        BackgroundWorker.__init__(self,background)
+
+    # Request func(arg), to be returned with key by results
+    def submit(self,key,arg):
+
+        if not self.background:
+            self.work((key,arg))
+            return
+
+        with self.cond:
+            self.check()
+            assert not self.closed
+            self.pending = (key,arg)
+            self.cond.notify_all()
+
+    # Returns list of (key, arg, func(arg)) for calculations finished since
+    # the last call, in the order they were submitted. If wait is True,
+    # waits for the calculations that have been requested first.
+    def results(self,wait=False):
+
+        if wait:
+            self.flush()
+
+        with self.cond:
+            self.check()
+            done,self.done = self.done,[]
+
+        return done
+
+    def waiting(self):
+
+        return self.pending is not None
+
+    def take(self):
+
+        task,self.pending = self.pending,None
+        return task
+
+    def work(self,task):
+
+        key,arg = task
+        result = self.func(arg)
+        with self.cond:
+            self.done.append((key,arg,result))
+
+    # Discard requests that have not started and stop the background thread
+    def close(self):
+
+        with self.cond:
+            self.pending = None
+        BackgroundWorker.close(self)
+
+def openStim(stim,tempdir=None):
+    """
+    Open a stimulus that may not fit in memory
+        stim: numpy array (including numpy.memmap), path to a .npy file,
+           list of paths to .npy files holding consecutive chunks of frames
+           (sample number as last dimension), or dict of numpy.memmap
+           arguments (filename, dtype, offset, shape, order) of a raw file.
+        tempdir: Directory for the file joining a list of chunk files.
+           Defaults to the system temporary directory.
+        Returns numpy array, or read-only memmap if stim is a file, list of
+        files, or dict. Chunk files are copied one at a time into a single memmapped
+        file, which is removed once opened.
+    """
+    if isinstance(stim,str):
+        return load(stim,mmap_mode='r')
+
+    if isinstance(stim,dict):
+        return memmap(mode='r',**stim)
+
+    if isinstance(stim,(list,tuple)):
+        chunks = [load(f,mmap_mode='r') for f in stim]
+        shape = chunks[0].shape[:-1]+(sum([c.shape[-1] for c in chunks]),)
+        with NamedTemporaryFile(suffix='.npy',dir=tempdir,delete=False) as f:
+            name = f.name
+        try:
+            joined = open_memmap(name,mode='w+',dtype=chunks[0].dtype,shape=shape)
+            t = 0
+            for c in chunks:
+                assert c.shape[:-1] == shape[:-1]
+                joined[...,t:t+c.shape[-1]] = c
+                t += c.shape[-1]
+            joined.flush()
+            del joined
+            return load(name,mmap_mode='r')
+        finally:
+            remove(name)
+
+    return stim
+
+def stimStats(stim,pixelNorm=True,chunkSize=1024):
+    """
+    Calculate stimulus statistics in one pass, reading chunkSize frames at a
+    time, so that stim can be a memmap larger than memory
+        stim: numpy array or memmap with sample number as last dimension
+        pixelNorm: If True, statistics of each location. Otherwise, global
+           statistics.
+        Returns mean and stdev, shaped as in normStim.
+    Chunk means and sums of squared deviations are merged into running values
+    (Welford/Chan updates), so the statistics are calculated in float64
+    without keeping more than one chunk in memory.
+    """
+    axis = -1 if pixelNorm else None
+
+    N = 0
+    stimAve = 0.
+    M2 = 0.
+    for t in range(0,stim.shape[-1],chunkSize):
+        chunk = asarray(stim[...,t:t+chunkSize],dtype=float64)
+        n = chunk.shape[-1] if pixelNorm else chunk.size
+
+        # Statistics of chunk
+        ave = chunk.mean(axis)
+        if pixelNorm:
+            chunk = chunk-ave.reshape(ave.shape+(1,))
+        else:
+            chunk = chunk-ave
+        m2 = (chunk**2).sum(axis)
+
+        # Merge with running statistics
+        delta = ave-stimAve
+        stimAve = stimAve+delta*n/(N+n)
+        M2 = M2+m2+delta**2*N*n/(N+n)
+        N += n
+
+    stimStDev = sqrt(M2/N)
+    if pixelNorm:
+        stimAve.shape += (1,)
+        stimStDev.shape += (1,)
+
+    return stimAve,stimStDev
+
+class NormView(object):
+    """
+    NormView normalizes samples of a stimulus view (e.g. from gridStim or
+    frameStim of an unnormalized or memmapped stimulus) when they are indexed,
+    so that the full stimulus is never normalized in memory.
+    Constructor inputs:
+        view: Stimulus view with sample number as first dimension
+        stimAve, stimStDev: Statistics from stimStats or normStim
+        shape: Function applied to the (pixels x nlags) arrays of statistics
+           to arrange them like one sample of view, e.g.
+           lambda s: gridStim(s,fsize,nlags)
+        nlags: Number of frames in each sample
+        dtype: Type of normalized samples
+    Locations with zero stdev are set to 0, as in normStim.
+    """
+    def __init__(self,view,stimAve,stimStDev,shape,nlags=1,dtype=float):
+
+        self.view = view
+        self.shape = view.shape
+        self.dtype = dtype_(dtype)
+        stimAve = asarray(stimAve)
+
+        # Statistics for every pixel and lag
+        fsh = stimAve.shape[:-1]+(nlags,) if stimAve.ndim else ()
+        ave = ascontiguousarray(broadcast_to(stimAve,fsh),dtype=self.dtype)
+        with errstate(divide='ignore'):
+            scale = 1/asarray(stimStDev,dtype=float64)
+        scale = where(isfinite(scale),scale,0.)
+        scale = ascontiguousarray(broadcast_to(scale,fsh),dtype=self.dtype)
+
+        if stimAve.ndim:
+            ave = shape(ave)[0]
+            scale = shape(scale)[0]
+        self.ave = ave
+        self.scale = scale
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    def __getitem__(self,ind):
+
+        S = (self.view[ind]-self.ave).astype(self.dtype,copy=False)
+        S *= self.scale
+
+        return S
+
+class StimCache(object):
+    """
+    StimCache keeps normalized stimuli on disk so that repeated fits with the
+    same stimulus (other jackknives, models, neurons, or options) skip
+    normalization. Each entry is a .npy file of the normalized stimulus,
+    which is opened as a read-only memmap, and a .npz file with the mean,
+    stdev, and shape. Entries are keyed by a hash of the raw stimulus and the
+    normalization options. A stimulus given as a path or list of paths is
+    keyed by the path, size, and modification time of each file instead of
+    its contents, so that finding it in the cache does not read it.
+    Constructor inputs:
+        path: Directory holding the cache
+        maxBytes: If given, least recently used entries are removed when the
+            cache grows larger than this.
+        chunkSize: Number of frames read at once when hashing and normalizing
+    """
+    def __init__(self,path,maxBytes=None,chunkSize=1024):
+
+        self.path = expanduser(path)
+        if not isdir(self.path):
+            makedirs(self.path)
+        self.maxBytes = maxBytes
+        self.chunkSize = chunkSize
+
+    # Key for stimulus and normalization options
+    def key(self,stim,pixelNorm,dtype):
+
+        h = blake2b(digest_size=20)
+        h.update(repr((pixelNorm if isinstance(pixelNorm,bool) else None,
+                       dtype_(dtype).str)).encode())
+        if isinstance(pixelNorm,tuple):
+            for p in pixelNorm:
+                h.update(ascontiguousarray(p,dtype=float64).tobytes())
+
+        if isinstance(stim,str):
+            stim = [stim]
+        if isinstance(stim,(list,tuple)):
+            for f in stim:
+                st = stat(f)
+                h.update(repr((abspath(f),st.st_size,st.st_mtime)).encode())
+        else:
+            h.update(repr((stim.shape,stim.dtype.str)).encode())
+            for t in range(0,stim.shape[-1],self.chunkSize):
+                h.update(ascontiguousarray(stim[...,t:t+self.chunkSize]).tobytes())
+
+        return h.hexdigest()
+
+    # Files of cache entry
+    def files(self,key):
+
+        return join(self.path,key+'.npy'),join(self.path,key+'.npz')
+
+    def normalize(self,stim,pixelNorm=True,dtype=float):
+        """
+        Return normalized stimulus as a read-only memmap with its mean and
+        stdev, normalizing and storing it first if it is not in the cache.
+            stim: numpy array, memmap, or file(s) accepted by openStim
+            pixelNorm: As in normStim
+            dtype: Type of normalized stimulus
+        """
+        key = self.key(stim,pixelNorm,dtype)
+        stimName,metaName = self.files(key)
+
+        if not (exists(stimName) and exists(metaName)):
+            self.store(openStim(stim),pixelNorm,dtype,stimName,metaName)
+        else:
+            # Mark entry as recently used
+            utime(stimName)
+            utime(metaName)
+
+        with load(metaName) as meta:
+            stimAve,stimStDev = meta['stimAve'],meta['stimStDev']
+
+        return load(stimName,mmap_mode='r'),stimAve,stimStDev
+
+    # Normalize stimulus into new cache entry
+    def store(self,stim,pixelNorm,dtype,stimName,metaName):
+
+        if isinstance(pixelNorm,tuple):
+            stimAve,stimStDev = pixelNorm
+        else:
+            stimAve,stimStDev = stimStats(stim,pixelNorm,self.chunkSize)
+        stimAve = asarray(stimAve,dtype=float64)
+        stimStDev = asarray(stimStDev,dtype=float64)
+
+        # Write to temporary files and rename so that concurrent fits never
+        # see a partial entry
+        tempStim = stimName+'.%u.tmp' % (getpid(),)
+        tempMeta = metaName+'.%u.tmp' % (getpid(),)
+        out = open_memmap(tempStim,mode='w+',dtype=dtype,shape=stim.shape)
+        with errstate(divide='ignore',invalid='ignore'):
+            for t in range(0,stim.shape[-1],self.chunkSize):
+                chunk = (stim[...,t:t+self.chunkSize]-stimAve)/stimStDev
+                chunk[~isfinite(chunk)] = 0.
+                out[...,t:t+self.chunkSize] = chunk
+        out.flush()
+        del out
+        with open(tempMeta,'wb') as f:
+            savez(f,stimAve=stimAve,stimStDev=stimStDev,shape=array(stim.shape))
+        replace(tempStim,stimName)
+        replace(tempMeta,metaName)
+
+        self.evict(keep=stimName)
+
+    # Remove least recently used entries until cache is below maxBytes
+    def evict(self,keep=None):
+
+        if self.maxBytes is None:
+            return
+
+        entries = []
+        for f in listdir(self.path):
+            if f.endswith('.npy'):
+                stimName,metaName = self.files(f[:-4])
+                size = getsize(stimName)
+                if exists(metaName):
+                    size += getsize(metaName)
+                entries.append((getmtime(stimName),size,stimName,metaName))
+        entries.sort()
+
+        total = sum([e[1] for e in entries])
+        for mtime,size,stimName,metaName in entries:
+            if total <= self.maxBytes:
+                break
+            if stimName == keep:
+                continue
+            remove(stimName)
+            if exists(metaName):
+                remove(metaName)
+            total -= size